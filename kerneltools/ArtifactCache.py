@@ -0,0 +1,223 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class ArtifactCache."""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+
+##############################################################################
+# ArtifactCache
+
+class ArtifactCache(object):
+   """Directory of build artifacts, each stored in an entry named after a
+   hash of the inputs that produced it. The directory can be shared by
+   multiple hosts (e.g. over NFS): entries are created under a temporary name
+   and renamed into place once complete, and the least recently used entries
+   are evicted to keep the total size within a limit, but never while an entry
+   is being read by lookup()’s caller.
+   """
+
+   # Name of the file describing the inputs of each entry.
+   _inputs_file_name = 'inputs.json'
+   # Name of the file locked to serialize evictions, and to protect entries
+   # being read from them.
+   _lock_file_name = '.lock'
+
+   def __init__(self, cache_path, max_bytes):
+      """Constructor.
+
+      str cache_path
+         Path to the cache directory; it will be created if missing.
+      int max_bytes
+         Maximum total size of the entries.
+      """
+
+      self._cache_path = cache_path
+      self._max_bytes = max_bytes
+
+   def _evict(self, keep = None):
+      """Deletes the least recently used entries until the total size of the
+      cache is within the limit. Must be called with the cache locked.
+
+      str keep
+         Key of an entry that must not be evicted, e.g. the one just stored.
+      list(str) return
+         Keys of the evicted entries.
+      """
+
+      entries = []
+      total_size = 0
+      for key in os.listdir(self._cache_path):
+         entry_path = os.path.join(self._cache_path, key)
+         if key.startswith('.') or not os.path.isdir(entry_path):
+            # Lock file or entry being stored.
+            continue
+         size = self._tree_size(entry_path)
+         total_size += size
+         entries.append((os.stat(entry_path).st_mtime, key, size))
+      # Evict the least recently used entries first.
+      entries.sort()
+      ret = []
+      for mtime, key, size in entries:
+         if total_size <= self._max_bytes:
+            break
+         if key == keep:
+            continue
+         shutil.rmtree(
+            os.path.join(self._cache_path, key), ignore_errors=True
+         )
+         total_size -= size
+         ret.append(key)
+      return ret
+
+   @staticmethod
+   def key(inputs):
+      """Computes the key of the entry for the specified inputs.
+
+      dict(str: object) inputs
+         Inputs of the build, as JSON-serializable values.
+      str return
+         Key.
+      """
+
+      return hashlib.sha256(
+         json.dumps(inputs, sort_keys=True).encode('utf-8')
+      ).hexdigest()
+
+   def _lock(self, shared = False):
+      """Opens and locks the lock file of the cache, creating the cache
+      directory if needed.
+
+      bool shared
+         If True, the lock will be shared with other readers; if False
+         (default), it will be exclusive.
+      file return
+         Lock file; closing it releases the lock.
+      """
+
+      if not os.path.isdir(self._cache_path):
+         os.makedirs(self._cache_path)
+      lock_file = open(
+         os.path.join(self._cache_path, self._lock_file_name), 'a'
+      )
+      fcntl.flock(
+         lock_file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+      )
+      return lock_file
+
+   @contextlib.contextmanager
+   def lookup(self, key):
+      """Context manager that looks up an entry, marking it as the most
+      recently used, and keeps it from being evicted until exited. Since
+      store() waits for that, it must not be called within the context.
+
+      str key
+         Key of the entry, as returned by key().
+      str yield
+         Path to the entry directory, or None if not in the cache.
+      """
+
+      lock_file = self._lock(shared=True)
+      try:
+         entry_path = os.path.join(self._cache_path, key)
+         if not os.path.isfile(
+            os.path.join(entry_path, self._inputs_file_name)
+         ):
+            entry_path = None
+         else:
+            os.utime(entry_path, None)
+         yield entry_path
+      finally:
+         lock_file.close()
+
+   def store(self, inputs, populate):
+      """Adds an entry to the cache, evicting older entries if necessary.
+
+      dict(str: object) inputs
+         Inputs of the build that produced the artifacts, as
+         JSON-serializable values.
+      callable(str) populate
+         Function that will be called with the path of an empty directory,
+         and must fill it with the artifacts.
+      str return
+         Key of the new entry.
+      """
+
+      key = self.key(inputs)
+      lock_file = self._lock()
+      try:
+         tmp_entry_path = os.path.join(self._cache_path, '.{}.{}.{}'.format(
+            key, socket.gethostname(), os.getpid()
+         ))
+         if os.path.isdir(tmp_entry_path):
+            shutil.rmtree(tmp_entry_path)
+         os.mkdir(tmp_entry_path)
+      finally:
+         lock_file.close()
+      populated = False
+      try:
+         populate(tmp_entry_path)
+         with open(
+            os.path.join(tmp_entry_path, self._inputs_file_name), 'w'
+         ) as inputs_file:
+            json.dump(inputs, inputs_file, indent=1, sort_keys=True)
+            inputs_file.write('\n')
+         populated = True
+      finally:
+         if not populated:
+            shutil.rmtree(tmp_entry_path, ignore_errors=True)
+      lock_file = self._lock()
+      try:
+         entry_path = os.path.join(self._cache_path, key)
+         if os.path.isdir(entry_path):
+            # Another host stored the same entry in the meantime.
+            shutil.rmtree(tmp_entry_path)
+         else:
+            os.rename(tmp_entry_path, entry_path)
+         self._evict(keep=key)
+      finally:
+         lock_file.close()
+      return key
+
+   @staticmethod
+   def _tree_size(path):
+      """Computes the total size of the files in a directory.
+
+      str path
+         Path to the directory.
+      int return
+         Total size, in bytes.
+      """
+
+      ret = 0
+      for base_path, dir_names, file_names in os.walk(path):
+         for file_name in file_names:
+            try:
+               ret += os.lstat(os.path.join(base_path, file_name)).st_size
+            except OSError:
+               # Deleted in the meantime.
+               pass
+      return ret
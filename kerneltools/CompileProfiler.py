@@ -0,0 +1,292 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class CompileProfiler.
+
+When executed as a script, this module acts as the compiler wrapper installed
+by CompileProfiler.wrap_cc(); for this reason, it must only depend on the
+standard library.
+"""
+
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+try:
+   from shlex import quote as shell_quote
+except ImportError:
+   # Python 2.7.
+   from pipes import quote as shell_quote
+
+
+def _main(argv):
+   """Compiler wrapper: runs the compiler, then appends to the log a record of
+   the object it compiled.
+
+   list(str) argv
+      Script path, log path, then compiler and arguments.
+   int return
+      Exit status of the compiler.
+   """
+
+   log_path = argv[1]
+   args = argv[2:]
+   start = time.time()
+   ret = subprocess.call(args)
+   wall_time = time.time() - start
+   if ret != 0 or '-c' not in args or '-o' not in args[:-1]:
+      # Failed, or not compiling an object file (e.g. linking or
+      # preprocessing).
+      return ret
+   obj_path = args[args.index('-o') + 1]
+   if obj_path.startswith('/dev/') or '.tmp' in os.path.basename(obj_path):
+      # Compiler feature test.
+      return ret
+   usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+   record = json.dumps({
+      'object': os.path.normpath(obj_path),
+      'wall_time': wall_time,
+      'cpu_time': usage.ru_utime + usage.ru_stime,
+      'size': os.path.getsize(obj_path) if os.path.isfile(obj_path) else 0,
+   }) + '\n'
+   # Write each record with a single append, so that records written by
+   # concurrent make jobs don’t get mixed up.
+   log_fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+   try:
+      os.write(log_fd, record.encode('utf-8'))
+   finally:
+      os.close(log_fd)
+   return ret
+
+##############################################################################
+# CompileProfiler
+
+class CompileProfiler(object):
+   """Records the wall time, CPU time and output size of each object file
+   compiled during a kernel build, by wrapping the compiler, and reports the
+   most expensive objects, directories and configuration options.
+   """
+
+   # Matches the start of a kbuild assignment listing objects, such as
+   # “obj-$(CONFIG_FOO) += foo.o bar/”, “foo-y := a.o b.o” or “foo-m += c.o”.
+   _kbuild_assignment_re = re.compile(
+      r'^(?P<name>[A-Za-z0-9_]+)-(?:\$\((?P<config>CONFIG_[A-Za-z0-9_]+)\)|' +
+      r'(?P<cond>y|m|objs))\s*[:+]?=\s*(?P<value>.*)$'
+   )
+
+   def __init__(self, log_path, source_path):
+      """Constructor.
+
+      str log_path
+         Path to the file that will receive a JSON record for each compiled
+         object.
+      str source_path
+         Path to the kernel source, used to attribute objects to
+         configuration options by reading its Makefiles.
+      """
+
+      self._log_path = log_path
+      # Object-to-option maps parsed from each source directory’s Makefile.
+      self._makefile_rules = {}
+      self._source_path = source_path
+
+   def clear(self):
+      """Deletes any records left by a previous build."""
+
+      if os.path.exists(self._log_path):
+         os.unlink(self._log_path)
+
+   def _config_option(self, obj_path):
+      """Determines the configuration option that causes an object file to be
+      built, by looking for it in its directory’s Makefile and, failing that,
+      for the directory in its ancestors’ Makefiles.
+
+      str obj_path
+         Path to the object file, relative to the build directory.
+      str return
+         Configuration option, or None if the object is always built or its
+         option could not be determined.
+      """
+
+      dir_path, name = os.path.split(obj_path)
+      while True:
+         option = self._get_makefile_rules(dir_path).get(name)
+         if option or not dir_path:
+            return option
+         dir_path, name = os.path.split(dir_path)
+         name += '/'
+
+   def _get_makefile_rules(self, dir_path):
+      """Parses the kbuild Makefile of a source directory, mapping each object
+      file and subdirectory it lists to the configuration option it depends
+      on, either directly or through a composite object.
+
+      str dir_path
+         Path to the directory, relative to the source directory.
+      dict(str: str) return
+         Configuration option, by object file or subdirectory (with a
+         trailing “/”) name.
+      """
+
+      ret = self._makefile_rules.get(dir_path)
+      if ret is not None:
+         return ret
+      ret = {}
+      self._makefile_rules[dir_path] = ret
+      for makefile_name in ('Kbuild', 'Makefile'):
+         makefile_path = os.path.join(
+            self._source_path, dir_path, makefile_name
+         )
+         if os.path.isfile(makefile_path):
+            break
+      else:
+         return ret
+      with open(makefile_path, 'r') as makefile:
+         # Join continuation lines.
+         lines = makefile.read().replace('\\\n', ' ').splitlines()
+      # Members of composite objects, by composite object name.
+      composites = {}
+      for line in lines:
+         match = self._kbuild_assignment_re.match(line)
+         if not match:
+            continue
+         name = match.group('name')
+         config = match.group('config')
+         for target in match.group('value').split('#', 1)[0].split():
+            if name == 'obj':
+               if config and target.endswith(('.o', '/')):
+                  ret.setdefault(target, config)
+            elif target.endswith('.o'):
+               composites.setdefault(name + '.o', []).append(
+                  (target, config)
+               )
+      # Members inherit the option of their composite object, unless they
+      # have one of their own.
+      for composite, members in composites.items():
+         for member, config in members:
+            ret.setdefault(member, config or ret.get(composite))
+      return ret
+
+   def _load(self):
+      """Reads the records of the objects compiled.
+
+      list(dict(str: object)) return
+         Records, in the order they were written.
+      """
+
+      ret = []
+      if not os.path.exists(self._log_path):
+         return ret
+      with open(self._log_path, 'r') as log_file:
+         for line in log_file:
+            try:
+               ret.append(json.loads(line))
+            except ValueError:
+               # Truncated by an interrupted build.
+               pass
+      return ret
+
+   def profile(self, top = 20):
+      """Aggregates the records of the objects compiled.
+
+      int top
+         Number of most expensive objects, directories and configuration
+         options to list.
+      dict(str: object) return
+         Profile, suitable for JSON serialization.
+      """
+
+      def new_totals():
+         return {'objects': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'size': 0}
+
+      def add_to_totals(totals, record):
+         totals['objects'] += 1
+         totals['wall_time'] += record['wall_time']
+         totals['cpu_time'] += record['cpu_time']
+         totals['size'] += record['size']
+
+      def most_expensive(totals_by_key, key_name):
+         ret = []
+         for key, totals in totals_by_key.items():
+            totals[key_name] = key
+            ret.append(totals)
+         ret.sort(key=lambda totals: totals['cpu_time'], reverse=True)
+         return ret[:top]
+
+      total = new_totals()
+      by_config = {}
+      by_dir = {}
+      objects = self._load()
+      for record in objects:
+         record['config'] = self._config_option(record['object'])
+         add_to_totals(total, record)
+         if record['config']:
+            add_to_totals(
+               by_config.setdefault(record['config'], new_totals()), record
+            )
+         # Add the object to each directory containing it.
+         dir_path = os.path.dirname(record['object'])
+         while dir_path:
+            add_to_totals(by_dir.setdefault(dir_path, new_totals()), record)
+            dir_path = os.path.dirname(dir_path)
+      return {
+         'total': total,
+         'objects': sorted(
+            objects, key=lambda record: record['cpu_time'], reverse=True
+         )[:top],
+         'directories': most_expensive(by_dir, 'path'),
+         'configs': most_expensive(by_config, 'config'),
+      }
+
+   def wrap_cc(self, cc):
+      """Returns a compiler command that runs the specified one through this
+      module’s compiler wrapper.
+
+      str cc
+         Compiler command, possibly including a wrapper such as distcc.
+      str return
+         Wrapped compiler command, suitable for make’s CC variable.
+      """
+
+      return ' '.join(
+         shell_quote(arg)
+         for arg in (sys.executable, os.path.abspath(__file__), self._log_path)
+      ) + ' ' + cc
+
+   def write_json(self, file_path, top = 20):
+      """Writes the profile returned by profile() to a JSON file.
+
+      str file_path
+         Path to the file to write.
+      int top
+         Number of most expensive objects, directories and configuration
+         options to list.
+      """
+
+      with open(file_path, 'w') as json_file:
+         json.dump(self.profile(top), json_file, indent=1, sort_keys=True)
+         json_file.write('\n')
+
+if __name__ == '__main__':
+   sys.exit(_main(sys.argv))
@@ -0,0 +1,203 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class EventStream."""
+
+import contextlib
+import re
+import resource
+import subprocess
+import threading
+import time
+
+##############################################################################
+# EventStream
+
+class EventStream(object):
+   """Delivers progress events to subscribers.
+
+   Each event is a dictionary of JSON-serializable values, with at least these
+   keys:
+
+   str event
+      Type of event: “message”, “phase_start”, “phase_end”, “process_start”,
+      “process_output”, “process_exit”, “copy”, “deduplicate” or
+      “archive”.
+   float time
+      Time at which the event occurred, in seconds since the epoch.
+   """
+
+   # Matches ANSI escape sequences, such as color changes.
+   _ansi_escape_re = re.compile(r'\033\[[0-9;]*[A-Za-z]')
+   # Message prefixes used by console_subscriber(), by level.
+   _console_prefixes = {
+      'error'  : '[E] ',
+      'info'   : '[I] ',
+      'warning': '[W] ',
+   }
+
+   def __init__(self):
+      """Constructor."""
+
+      # Reentrant, so that subscribers can emit events themselves.
+      self._lock = threading.RLock()
+      self._subscribers = []
+
+   @classmethod
+   def console_subscriber(cls, event):
+      """Subscriber that prints messages to stdout, ignoring other events.
+
+      dict(str: object) event
+         Event.
+      """
+
+      if event['event'] == 'message':
+         print(
+            '  ' * event['depth'] + cls._console_prefixes[event['level']] +
+            event['ansi_text']
+         )
+
+   def emit(self, event_type, **data):
+      """Delivers an event to every subscriber.
+
+      str event_type
+         Type of event.
+      dict(str: object) data
+         Event-specific values.
+      """
+
+      data['event'] = event_type
+      data['time'] = time.time()
+      with self._lock:
+         for subscriber in list(self._subscribers):
+            subscriber(data)
+
+   def message(self, level, text, depth = 0):
+      """Emits a “message” event.
+
+      str level
+         “info”, “warning” or “error”.
+      str text
+         Message, possibly containing ANSI escape sequences; these are
+         stripped from the “text” value and retained in “ansi_text”.
+      int depth
+         Indentation level of the message.
+      """
+
+      self.emit(
+         'message', level=level, text=self._ansi_escape_re.sub('', text),
+         ansi_text=text, depth=depth
+      )
+
+   @staticmethod
+   def _cpu_times():
+      """Returns the CPU time used so far by this process and by its child
+      processes that have been waited for.
+
+      tuple(float, float) return
+         User plus system time of this process and of its children, in
+         seconds.
+      """
+
+      self_usage = resource.getrusage(resource.RUSAGE_SELF)
+      children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+      return (
+         self_usage.ru_utime + self_usage.ru_stime,
+         children_usage.ru_utime + children_usage.ru_stime
+      )
+
+   @contextlib.contextmanager
+   def phase(self, phase):
+      """Context manager that emits “phase_start” on entry and “phase_end”,
+      with its duration, the CPU time used by this process and by child
+      processes, and whether it succeeded, on exit.
+
+      str phase
+         Name of the phase.
+      """
+
+      self.emit('phase_start', phase=phase)
+      start = time.time()
+      start_cpu_time, start_children_cpu_time = self._cpu_times()
+      succeeded = False
+      try:
+         yield
+         succeeded = True
+      finally:
+         cpu_time, children_cpu_time = self._cpu_times()
+         self.emit(
+            'phase_end', phase=phase, duration=time.time() - start,
+            cpu_time=cpu_time - start_cpu_time,
+            children_cpu_time=children_cpu_time - start_children_cpu_time,
+            succeeded=succeeded
+         )
+
+   @contextlib.contextmanager
+   def process(self, args):
+      """Context manager that emits “process_start” on entry and
+      “process_exit”, with its duration and exit status, on exit. The exit
+      status is the one stored by the caller in the yielded dictionary, or
+      else taken from a subprocess.CalledProcessError raised in the context,
+      or assumed to be 0.
+
+      iterable(str*) args
+         Program and arguments.
+      dict(str: int) yield
+         Dictionary in which the caller can store the exit status of a
+         program whose failure doesn’t raise an exception, as “returncode”.
+      """
+
+      args = list(args)
+      self.emit('process_start', args=args)
+      start = time.time()
+      status = {'returncode': None}
+      try:
+         yield status
+      except subprocess.CalledProcessError as x:
+         status['returncode'] = x.returncode
+         raise
+      else:
+         if status['returncode'] is None:
+            status['returncode'] = 0
+      finally:
+         self.emit(
+            'process_exit', args=args, duration=time.time() - start,
+            returncode=status['returncode']
+         )
+
+   def subscribe(self, subscriber):
+      """Adds a subscriber.
+
+      callable(dict(str: object)) subscriber
+         Function to be called with each event.
+      """
+
+      with self._lock:
+         self._subscribers.append(subscriber)
+
+   def unsubscribe(self, subscriber):
+      """Removes a subscriber.
+
+      callable(dict(str: object)) subscriber
+         Function previously passed to subscribe().
+      """
+
+      with self._lock:
+         self._subscribers.remove(subscriber)
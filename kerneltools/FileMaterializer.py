@@ -0,0 +1,284 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class FileMaterializer."""
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+
+##############################################################################
+# FileMaterializer
+
+class FileMaterializer(object):
+   """Places files into staging trees while avoiding reading and writing
+   their contents whenever possible: files are hardlinked if source and
+   destination are on the same file system, otherwise reflinked, otherwise
+   copied in the kernel with copy_file_range(), and only as a last resort
+   copied normally.
+
+   Since hardlinked files share their contents with the source, staged files
+   must be replaced rather than modified in place.
+   """
+
+   # ioctl to share a file’s extents with another file, from linux/fs.h.
+   _FICLONE = 0x40049409
+   # Maximum number of bytes to copy with a single copy_file_range() call.
+   _copy_chunk_size = 1024 * 1024 * 1024
+   # Size of the chunks in which files are read to hash them.
+   _hash_chunk_size = 1024 * 1024
+
+   def __init__(self, hardlink = True):
+      """Constructor.
+
+      bool hardlink
+         If False, files will never be hardlinked, only cloned or copied.
+      """
+
+      # Digest of the contents of each file hashed by deduplicate_tree(), by
+      # device, inode, size and modification time.
+      self._digests = {}
+      self._hardlink = hardlink
+      # Number of files and bytes materialized using each method.
+      self._stats = dict(
+         (method, {'files': 0, 'bytes': 0})
+         for method in ('hardlink', 'reflink', 'copy_file_range', 'copy')
+      )
+
+   def _add_stat(self, method, size):
+      """Accounts for a materialized file.
+
+      str method
+         Method used to materialize the file.
+      int size
+         Size of the file.
+      """
+
+      self._stats[method]['files'] += 1
+      self._stats[method]['bytes'] += size
+
+   def _clone_or_copy(self, src_path, dst_path, size):
+      """Creates dst_path with the same contents as src_path, without
+      hardlinking them.
+
+      str src_path
+         Path to the source file.
+      str dst_path
+         Path to the destination file.
+      int size
+         Size of the source file.
+      str return
+         Method used to materialize the file.
+      """
+
+      with open(src_path, 'rb') as src_file:
+         with open(dst_path, 'wb') as dst_file:
+            try:
+               fcntl.ioctl(dst_file.fileno(), self._FICLONE, src_file.fileno())
+               return 'reflink'
+            except (IOError, OSError):
+               # Not supported by the file system(s), or not the same one.
+               pass
+            if hasattr(os, 'copy_file_range'):
+               try:
+                  copied = 0
+                  while copied < size:
+                     chunk_size = os.copy_file_range(
+                        src_file.fileno(), dst_file.fileno(),
+                        min(size - copied, self._copy_chunk_size)
+                     )
+                     if chunk_size == 0:
+                        break
+                     copied += chunk_size
+                  return 'copy_file_range'
+               except OSError:
+                  # Not supported across these file systems; start over.
+                  src_file.seek(0)
+                  dst_file.seek(0)
+                  dst_file.truncate()
+            shutil.copyfileobj(src_file, dst_file)
+            return 'copy'
+
+   def copy_file(self, src_path, dst_path):
+      """Materializes a single file (or symlink) at dst_path, replacing any
+      existing file.
+
+      str src_path
+         Path to the source file.
+      str dst_path
+         Path to the destination file.
+      int return
+         Size of the materialized file; 0 for symlinks.
+      """
+
+      src_st = os.lstat(src_path)
+      if os.path.lexists(dst_path):
+         os.unlink(dst_path)
+      if stat.S_ISLNK(src_st.st_mode):
+         os.symlink(os.readlink(src_path), dst_path)
+         return 0
+      if self._hardlink:
+         dst_dir_st = os.stat(os.path.dirname(dst_path) or '.')
+         if dst_dir_st.st_dev == src_st.st_dev:
+            try:
+               os.link(src_path, dst_path)
+               self._add_stat('hardlink', src_st.st_size)
+               return src_st.st_size
+            except OSError as x:
+               # EPERM is returned when fs.protected_hardlinks forbids the
+               # link; for anything else, let the fallbacks fail instead.
+               if x.errno not in (errno.EPERM, errno.EXDEV, errno.EMLINK):
+                  raise
+      method = self._clone_or_copy(src_path, dst_path, src_st.st_size)
+      shutil.copystat(src_path, dst_path)
+      self._add_stat(method, src_st.st_size)
+      return src_st.st_size
+
+   def copy_tree(self, src_path, dst_path):
+      """Materializes the contents of a directory into another, which may
+      already exist; existing files are replaced, symlinks are preserved.
+
+      str src_path
+         Path to the source directory.
+      str dst_path
+         Path to the destination directory.
+      tuple(int, int) return
+         Number of files (including symlinks) and bytes materialized.
+      """
+
+      files = 0
+      size = 0
+      src_path_len = len(src_path.rstrip('/')) + 1
+      for base_path, dir_names, file_names in os.walk(src_path):
+         rel_base_path = base_path[src_path_len:]
+         dst_base_path = os.path.join(dst_path, rel_base_path)
+         if not os.path.isdir(dst_base_path):
+            os.makedirs(dst_base_path)
+            shutil.copystat(base_path, dst_base_path)
+         for dir_name in list(dir_names):
+            dir_path = os.path.join(base_path, dir_name)
+            if os.path.islink(dir_path):
+               # Copy symlinks to directories as symlinks, without descending
+               # into them.
+               self.copy_file(dir_path, os.path.join(dst_base_path, dir_name))
+               dir_names.remove(dir_name)
+               files += 1
+         for file_name in file_names:
+            size += self.copy_file(
+               os.path.join(base_path, file_name),
+               os.path.join(dst_base_path, file_name)
+            )
+            files += 1
+      return files, size
+
+   def deduplicate_tree(self, path):
+      """Replaces files in a directory that have the same contents and mode
+      as another file in it with hardlinks to that file, so that archivers
+      that preserve hardlinks, such as cpio, only store their contents once.
+      Files are grouped by size and mode first, and only hashed if another
+      file has the same size and mode.
+
+      str path
+         Path to the directory.
+      tuple(int, int) return
+         Number of files replaced with hardlinks, and bytes saved.
+      """
+
+      # Empty files are not worth linking, since they only take up a header.
+      candidates = {}
+      for base_path, dir_names, file_names in os.walk(path):
+         for file_name in file_names:
+            file_path = os.path.join(base_path, file_name)
+            st = os.lstat(file_path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+               candidates.setdefault((st.st_size, st.st_mode), []).append(
+                  (file_path, st)
+               )
+      files = 0
+      size = 0
+      for (file_size, mode), entries in candidates.items():
+         if len(set((st.st_dev, st.st_ino) for _, st in entries)) < 2:
+            # All of them are already the same file.
+            continue
+         by_digest = {}
+         for file_path, st in sorted(entries, key=lambda entry: entry[0]):
+            by_digest.setdefault(self._file_digest(file_path, st), []).append(
+               (file_path, st)
+            )
+         for same_entries in by_digest.values():
+            kept_path, kept_st = same_entries[0]
+            for file_path, st in same_entries[1:]:
+               if (st.st_dev, st.st_ino) == (kept_st.st_dev, kept_st.st_ino):
+                  continue
+               # Replace the file atomically, and only after the link has
+               # been created.
+               tmp_path = file_path + '.kernel-gen-link'
+               try:
+                  os.link(kept_path, tmp_path)
+               except OSError as x:
+                  # Not allowed, or too many links to the kept file; leave
+                  # this file alone.
+                  if x.errno not in (errno.EPERM, errno.EMLINK):
+                     raise
+                  continue
+               os.rename(tmp_path, file_path)
+               files += 1
+               size += file_size
+      return files, size
+
+   def _file_digest(self, file_path, st):
+      """Hashes the contents of a file, unless the same file was already
+      hashed.
+
+      str file_path
+         Path to the file.
+      os.stat_result st
+         Status of the file.
+      bytes return
+         SHA-256 digest of the contents of the file.
+      """
+
+      key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+      ret = self._digests.get(key)
+      if ret is None:
+         hasher = hashlib.sha256()
+         with open(file_path, 'rb') as src_file:
+            while True:
+               chunk = src_file.read(self._hash_chunk_size)
+               if not chunk:
+                  break
+               hasher.update(chunk)
+         ret = hasher.digest()
+         self._digests[key] = ret
+      return ret
+
+   def stats(self):
+      """Returns the number of files and bytes materialized using each
+      method.
+
+      dict(str: dict(str: int)) return
+         “files” and “bytes” counts, by method (“hardlink”, “reflink”,
+         “copy_file_range” or “copy”).
+      """
+
+      return self._stats
@@ -20,15 +20,34 @@
 
 """Implementation of the class Generator."""
 
+import collections
+import contextlib
+import functools
 import glob
+import hashlib
+import multiprocessing
+import multiprocessing.pool
 import os
+import portage.dep as portage_dep
 import portage.package.ebuild.config as portage_config
 import re
 import shlex
 import shutil
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from . import OutOfTreeEnumerator
+from .ArtifactCache import ArtifactCache
+from .CompileProfiler import CompileProfiler
+from .EventStream import EventStream
+from .FileMaterializer import FileMaterializer
+from .InitramfsProfiler import InitramfsProfiler
+from .ModuleInfo import ModuleInfo
+from .OutputLog import OutputLog
+from .PhaseCheckpoints import PhaseCheckpoints
 
 
 def makedirs(path):
@@ -45,13 +64,170 @@ def makedirs(path):
       if not os.path.isdir(path):
          raise
 
+def meminfo():
+   """Reads the system memory statistics from /proc/meminfo.
+
+   dict(str: int) return
+      Statistics, in bytes, by name (e.g. “MemAvailable”).
+   """
+
+   ret = {}
+   with open('/proc/meminfo', 'r') as meminfo_file:
+      for line in meminfo_file:
+         fields = line.split()
+         if len(fields) >= 2 and fields[1].isdigit():
+            value = int(fields[1])
+            if len(fields) >= 3 and fields[2] == 'kB':
+               value *= 1024
+            ret[fields[0].rstrip(':')] = value
+   return ret
+
+def online_cpus():
+   """Returns the number of CPUs this process can run on.
+
+   int return
+      Number of CPUs.
+   """
+
+   if hasattr(os, 'sched_getaffinity'):
+      return len(os.sched_getaffinity(0))
+   else:
+      return multiprocessing.cpu_count()
+
+def split_make_jobs_args(args):
+   """Separates make options that set the number of jobs or the load limit
+   from any other options.
+
+   iterable(str*) args
+      make options, e.g. from ${MAKEOPTS}.
+   tuple(list(str*), list(str*)) return
+      Job and load limit options, and all other options.
+   """
+
+   jobs_args = []
+   other_args = []
+   args = list(args)
+   i = 0
+   while i < len(args):
+      arg = args[i]
+      if re.match(r'^(?:-[jl]|--jobs|--load-average|--max-load)$', arg):
+         # The value, if any, is in the next argument.
+         if i + 1 < len(args) and re.match(r'^\d+(?:\.\d*)?$', args[i + 1]):
+            i += 1
+            arg += '=' + args[i] if arg.startswith('--') else args[i]
+         jobs_args.append(arg)
+      elif re.match(
+         r'^(?:-[jl]\d|--jobs=|--load-average=|--max-load=)', arg
+      ):
+         jobs_args.append(arg)
+      else:
+         other_args.append(arg)
+      i += 1
+   return jobs_args, other_args
+
+def parse_size(size):
+   """Converts a size with an optional K, M, G or T (binary) suffix into a
+   number of bytes.
+
+   str size
+      Size to convert.
+   int return
+      Size in bytes, or None if size is not a valid size.
+   """
+
+   match = re.match(
+      r'^(?P<num>\d+)(?P<unit>[KMGT]?)(?:i?B)?$', size.strip(), re.IGNORECASE
+   )
+   if not match:
+      return None
+   return int(match.group('num')) * 1024 ** (
+      ' KMGT'.index(match.group('unit').upper() or ' ')
+   )
+
+def tree_digest(path):
+   """Computes a digest of the names, types, permissions, sizes and
+   modification times of everything in a directory tree, to detect changes to
+   it without reading every file.
+
+   str path
+      Path to the directory.
+   str return
+      Hexadecimal SHA-256 digest.
+   """
+
+   digest = hashlib.sha256()
+   for base_path, dir_names, file_names in os.walk(path):
+      dir_names.sort()
+      for name in sorted(dir_names + file_names):
+         file_path = os.path.join(base_path, name)
+         st = os.lstat(file_path)
+         digest.update('{}\0{}\0{}\0{}\n'.format(
+            os.path.relpath(file_path, path), st.st_mode, st.st_size,
+            st.st_mtime
+         ).encode('utf-8'))
+   return digest.hexdigest()
+
+def event_phase(phase):
+   """Decorator for Generator methods that emits “phase_start” and
+   “phase_end” events around each call.
+
+   str phase
+      Name of the phase.
+   callable return
+      Decorator.
+   """
+
+   def decorator(method):
+      @functools.wraps(method)
+      def wrapper(self, *args, **kwargs):
+         with self._events.phase(phase):
+            return method(self, *args, **kwargs)
+      return wrapper
+   return decorator
+
+@contextlib.contextmanager
+def portage_config_env(configs, env):
+   """Context manager that temporarily sets environment variables in Portage
+   configurations, so that they only reach the ebuilds merged with them.
+
+   iterable(portage.package.ebuild.config.config*) configs
+      Configurations to modify.
+   dict(str: str) env
+      Environment variables to set; if None, nothing is changed.
+   """
+
+   configs = list(configs) if env else []
+   saved = []
+   for config in configs:
+      backupenv = config.configdict['backupenv']
+      saved.append(dict((name, backupenv.get(name)) for name in env))
+      config.unlock()
+      for name, value in env.items():
+         config[name] = value
+         config.backup_changes(name)
+      config.lock()
+   try:
+      yield
+   finally:
+      # Restore in reverse order, in case a configuration was listed twice.
+      for config, saved_env in reversed(list(zip(configs, saved))):
+         config.unlock()
+         for name, value in saved_env.items():
+            if value is None:
+               config.configdict['backupenv'].pop(name, None)
+               config.configdict['env'].pop(name, None)
+            else:
+               config[name] = value
+               config.backup_changes(name)
+         config.lock()
+
 ##############################################################################
 # Compressor
 
 class Compressor(object):
    """Stores information about an external compressor program."""
 
-   def __init__(self, config_name, ext, cmd_args):
+   def __init__(self, config_name, ext, cmd_args, decompress_cmd_args):
       """Constructor.
 
       str config_name
@@ -60,10 +236,14 @@ class Compressor(object):
          Default file name extension for files compressed by this program.
       iterable(str*) cmd_args
          Command-line arguments to use to run the compressor.
+      iterable(str*) decompress_cmd_args
+         Command-line arguments to use to run the decompressor, reading from
+         stdin and writing to stdout.
       """
 
       self._cmd_args = cmd_args
       self._config_name = config_name
+      self._decompress_cmd_args = decompress_cmd_args
       self._ext = ext
 
    def cmd_args(self):
@@ -75,6 +255,24 @@ class Compressor(object):
 
       return self._cmd_args
 
+   def config_name(self):
+      """Returns the name of the compressor as per Linux’s .config file.
+
+      str return
+         Compressor name, or None if this is not a real compressor.
+      """
+
+      return self._config_name
+
+   def decompress_cmd_args(self):
+      """Returns the command-line arguments to use to run the decompressor.
+
+      iterable(str*) return
+         Command-line arguments.
+      """
+
+      return self._decompress_cmd_args
+
    def enabled_in_config(self, kernel_config, prefix):
       """Checks if the compressor is enabled, with the given prefix, in the
       specified kernel configuration.
@@ -122,12 +320,23 @@ class Generator(object):
 
    # List of supported compressors, in order of preference.
    _compressors = [
-      Compressor('LZO',   '.lzo' , ('lzop',  '-9')),
-      Compressor('LZMA',  '.lzma', ('lzma',  '-9')),
-      Compressor('BZIP2', '.bz2' , ('bzip2', '-9')),
-      Compressor('GZIP',  '.gz'  , ('gzip',  '-9')),
-      Compressor(None,    ''     , ('cat',       )),
+      Compressor('LZO',   '.lzo' , ('lzop',  '-9'), ('lzop',  '-dc')),
+      Compressor('LZMA',  '.lzma', ('lzma',  '-9'), ('lzma',  '-dc')),
+      Compressor('BZIP2', '.bz2' , ('bzip2', '-9'), ('bzip2', '-dc')),
+      Compressor('GZIP',  '.gz'  , ('gzip',  '-9'), ('gzip',  '-dc')),
+      Compressor('XZ',    '.xz'  , ('xz', '--check=crc32', '-9'),
+                                                    ('xz',    '-dc')),
+      Compressor('LZ4',   '.lz4' , ('lz4', '-l', '-9'),
+                                                    ('lz4',   '-dc')),
+      Compressor('ZSTD',  '.zst' , ('zstd',  '-19'), ('zstd', '-dc')),
+      Compressor(None,    ''     , ('cat',       ), ('cat',        )),
    ]
+   # Policies that can be used to select an initramfs compressor by
+   # benchmarking it on the actual archive.
+   _irf_compression_policies = ('smallest', 'fastest')
+   # Maximum amount of the uncompressed initramfs archive used to benchmark
+   # compressors.
+   _irf_compression_sample_size = 64 * 1024 * 1024
    # ebuild template that will be dropped in the selected overlay and made
    # into a binary package.
    _ebuild_template = '''
@@ -160,19 +369,47 @@ class Generator(object):
       'x86'  : 'i386',
    }
 
-   def __init__(self, root = None, portage_arch = None):
+   # Extensions that installed kernel module files can have, depending on
+   # CONFIG_MODULE_COMPRESS_*.
+   _module_file_exts = ('', '.gz', '.xz', '.zst')
+   # Default amount of memory needed by each make job.
+   _make_job_memory = 512 * 1024 * 1024
+   # Memory to leave available for the compiler when putting the build
+   # directory on tmpfs.
+   _tmpfs_reserved_memory = 2 * 1024 * 1024 * 1024
+   # Name of the file that marks a tmpfs build directory as mounted by
+   # kernel-gen, so that a resumed run can take it over.
+   _tmpfs_marker_file_name = '.kernel-gen-tmpfs'
+
+   def __init__(self, root = None, portage_arch = None, console = True):
       """Constructor.
 
       str root
          Portage root directory; defaults to Portage’s ${ROOT}.
       str portage_arch
          Portage architecture; defaults to Portage’s ${ARCH}.
+      bool console
+         If True, messages will be printed to stdout; if False, they will
+         only be delivered to subscribers of events().
       """
 
+      self._events = EventStream()
+      if console:
+         self._events.subscribe(EventStream.console_subscriber)
       if root:
          # Set this now to override Portage’s default root.
          os.environ['ROOT'] = root
+      self._artifact_cache = None
+      self._build_config_path = None
+      self._build_path = None
+      self._build_tmpfs_mounted = False
+      self._build_tmpfs_size = None
+      # In-tree modules restored from the artifact cache; set by
+      # set_sources().
+      self._cached_modules_path = None
       self._category = None # Set by make_package_name()
+      self._compile_profile_path = None
+      self._checkpoints = None # Set by set_sources()
       self._portage_config = portage_config.config()
       if not root:
          # Set this now to override the null root with Portage’s default root.
@@ -181,38 +418,74 @@ class Generator(object):
       self._dev_null = open(os.devnull, 'w')
       self._ebuild_file_path = None
       self._ebuild_pkg_root = None
-      self._indent = ''
+      # Serializes the compressor benchmarks of concurrently built initramfs
+      # variants, so that they don’t compete for CPUs.
+      self._irf_compression_lock = threading.Lock()
+      self._irf_compression_policy = None
+      self._irf_compression_read_speed = None
       self._irf_compressor = None
-      self._irf_archive_path = None
-      self._irf_source_path = None
+      self._irf_enabled_compressors = None # Set by set_sources()
+      self._irf_variants = None # Set by set_sources()
+      self._kbuild_output_path = None # Set by set_sources()
       self._kernel_release = None # Set by set_sources()
       self._kernel_version = None # Set by set_sources()
       self._kmake_args = ['make']
       self._kmake_args.extend(shlex.split(self._portage_config['MAKEOPTS']))
+      self._make_jobs = 'auto'
+      self._make_jobs_args = None # Set by set_sources()
+      self._make_load_average = None
       self._kmake_env = dict(os.environ)
+      # Used to stage files into ${D} and the initramfs, avoiding copies.
+      self._materializer = FileMaterializer()
       if not portage_arch:
          portage_arch = self._portage_config['ARCH']
       self._kmake_env['ARCH'] = self._portage_arch_to_kernel_arch.get(
          portage_arch, portage_arch
       )
       self._module_packages = None # Set by build_kernel()
+      self._oot_enumerator = None # Set by out_of_tree_enumerator()
+      # Child processes’ output goes to a log, rather than memory or the
+      # terminal.
+      self._state_path = os.path.join(
+         self._portage_config['PORTAGE_TMPDIR'], 'portage/.kernel-gen'
+      )
+      self._output_log = OutputLog(
+         os.path.join(self._state_path, 'output.log')
+      )
       self._package_name = None # Set by make_package_name()
       self._package_version = None # Set by make_package_name()
+      self._resume = False
       self._root = root
       self._source_path = None
       self._src_config_path = None
       self._src_image_path = None
+      # Holds the message indentation of each thread, since initramfs variants
+      # are built concurrently.
+      self._thread_state = threading.local()
+      self._thread_state.indent = ''
 
    def __del__(self):
       """Destructor."""
 
-      if self._ebuild_file_path:
-         self.einfo('Cleaning up package build temporary directory')
-         clean_proc = subprocess.Popen(
-            ('ebuild', self._ebuild_file_path, 'clean'),
-            stdout=self._dev_null, stderr=subprocess.STDOUT
+      resumable = bool(
+         self._ebuild_file_path and self._checkpoints.pending()
+      )
+      if resumable:
+         # The run didn’t complete; keep everything needed to resume it.
+         self.ewarn(
+            'Keeping the temporary ebuild and its build directory; run ' +
+            'again with --resume to'
          )
-         clean_proc.communicate()
+         self.ewarn('continue from the last completed phase.')
+      elif self._ebuild_file_path:
+         self.einfo('Cleaning up package build temporary directory')
+         clean_args = ('ebuild', self._ebuild_file_path, 'clean')
+         with self._events.process(clean_args) as status:
+            clean_proc = subprocess.Popen(
+               clean_args, stdout=self._dev_null, stderr=subprocess.STDOUT
+            )
+            clean_proc.communicate()
+            status['returncode'] = clean_proc.returncode
          clean_proc = None
 
          self.einfo('Deleting temporary ebuild')
@@ -227,35 +500,108 @@ class Generator(object):
                del files_list[i]
                break
          if files_list:
-            ewarn(
+            self.ewarn(
                'Not removing {} unknown files in package directory `{}\''
                .format(len(files_list), package_path)
             )
          else:
             os.rmdir(package_path)
 
+      if self._build_tmpfs_mounted and resumable:
+         # Unmounting it would throw away the kernel build.
+         self.ewarn('Leaving tmpfs build directory mounted for --resume.')
+      elif self._build_tmpfs_mounted:
+         self.einfo('Unmounting tmpfs build directory')
+         umount_args = ('umount', self._build_path)
+         with self._events.process(umount_args) as status:
+            status['returncode'] = subprocess.call(umount_args)
+
+      self._output_log.close()
       self._dev_null.close()
 
-   def build_initramfs(self, debug = False):
-      """Builds an initramfs for the kernel generated by build_kernel().
+   def artifact_cache_inputs(self):
+      """Collects the inputs that determine the kernel image and in-tree
+      modules built from the selected sources, to look them up in the
+      artifact cache.
+
+      dict(str: object) return
+         Inputs, as JSON-serializable values.
+      """
+
+      with open(self._src_config_path, 'rb') as config_file:
+         config_sha256 = hashlib.sha256(config_file.read()).hexdigest()
+      # Arguments that only affect where or how fast the kernel is built
+      # don’t matter.
+      make_args = []
+      args = iter(split_make_jobs_args(self._kmake_args[1:])[1])
+      for arg in args:
+         if arg == '--directory':
+            next(args, None)
+         elif not arg.startswith(('O=', 'CC=distcc')):
+            make_args.append(arg)
+      # The compiler, minus any wrappers that don’t affect its output.
+      cc_args = shlex.split(self.kernel_cc())
+      while cc_args and os.path.basename(cc_args[0]) in ('ccache', 'distcc'):
+         del cc_args[0]
+      cc_args = cc_args or ['cc']
+      with self._events.process(cc_args + ['--version']):
+         toolchain = subprocess.check_output(
+            cc_args + ['--version'], universal_newlines=True
+         ).splitlines()[0]
+      return {
+         'arch': self._kmake_env['ARCH'],
+         'cc': cc_args,
+         'config_sha256': config_sha256,
+         'kernel_release': self._kernel_release,
+         'kernel_version': self._kernel_version,
+         'make_args': make_args,
+         'package_name': self._package_name,
+         'toolchain': toolchain,
+      }
+
+   @event_phase('initramfs')
+   def build_initramfs(self, debug = False, profile_path = None):
+      """Builds the initramfs variants for the kernel generated by
+      build_kernel(). Kernel modules and firmware are staged once and shared
+      by all variants, which are then built in parallel.
 
       bool debug
          If True, the contents of the generated initramfs will be dumped to a
          file for later inspection.
+      str profile_path
+         If not None, a JSON profile of the size and origin of each file in
+         the initramfs will be written to this file; for named variants, the
+         variant name is added to the file name.
+      list(str*) return
+         Path to the archive of each variant, in the same order as the
+         variants.
       """
 
       self.einfo('Generating initramfs')
       self.eindent()
 
-      prev_cwd = os.getcwd()
-      irf_work_path = os.path.join(self._ebuild_pkg_root, 'initramfs-build')
-      os.mkdir(irf_work_path)
-      os.chdir(irf_work_path)
+      irf_base_path = os.path.join(self._ebuild_pkg_root, 'initramfs-build')
+      if os.path.isdir(irf_base_path):
+         # Left over by a failed run that is being resumed.
+         shutil.rmtree(irf_base_path)
+      os.mkdir(irf_base_path)
+      if profile_path:
+         profiler = InitramfsProfiler(irf_base_path)
+      else:
+         profiler = None
+
+      # Build programs may modify the files staged for them, which must then
+      # not be hardlinks to ${ROOT}, the artifact cache or other variants.
+      if any(
+         self.initramfs_build_program(irf_source_path)
+         for irf_source_path in self._irf_variants.values()
+      ):
+         materializer = FileMaterializer(hardlink=False)
+      else:
+         materializer = self._materializer
 
       self.einfo('Adding kernel modules')
-      self.kmake_check_call(
-         'INSTALL_MOD_PATH=' + irf_work_path, 'modules_install'
-      )
+      self.install_modules(irf_base_path, materializer)
       # TODO: configuration-driven exclusion of modules from the initramfs.
       excluded_mod_dirs = set([
          'arch/x86/kvm',
@@ -267,74 +613,247 @@ class Generator(object):
          'vhost',
       ])
       # Equivalent to executing:
-      #    rm -rf ${irf_work_path}/lib*/modules/*/kernel/${excluded_mod_dirs}
-      for dir in os.listdir(irf_work_path):
+      #    rm -rf ${irf_base_path}/lib*/modules/*/kernel/${excluded_mod_dirs}
+      for dir in os.listdir(irf_base_path):
          if dir.startswith('lib'):
-            modules_dir = os.path.join(irf_work_path, dir, 'modules')
+            modules_dir = os.path.join(irf_base_path, dir, 'modules')
             for dir in os.listdir(modules_dir):
                kernel_modules_dir = os.path.join(modules_dir, dir, 'kernel')
                for dir in excluded_mod_dirs:
                   dir = os.path.join(kernel_modules_dir, dir)
                   # Recursively remove the excluded directory.
                   shutil.rmtree(dir, ignore_errors=True)
+      if profiler:
+         profiler.add_step('modules_install')
 
       self.einfo('Adding out-of-tree firmware')
       # Create the directory beforehand; it not needed, we'll delete it later.
       src_firmware_path = os.path.join(self._root, 'lib/firmware')
-      dst_firmware_path = os.path.join(irf_work_path, 'lib/firmware')
-      oote = OutOfTreeEnumerator(firmware=True, modules=False)
-      for src_ext_firmware_path in oote.files():
-         dst_ext_firmware_path = os.path.join(
-            dst_firmware_path, src_ext_firmware_path
-         )
-         makedirs(os.path.dirname(dst_ext_firmware_path))
-         # Copy the firmware file.
-         shutil.copy2(
-            os.path.join(src_firmware_path, src_ext_firmware_path),
-            dst_ext_firmware_path
+      dst_firmware_path = os.path.join(irf_base_path, 'lib/firmware')
+      firmware_packages = {}
+      size = 0
+      for package, files in self.out_of_tree_enumerator().packages_and_files(
+         use_slot=False, modules=False
+      ):
+         for src_ext_firmware_path in files:
+            dst_ext_firmware_path = os.path.join(
+               dst_firmware_path, src_ext_firmware_path
+            )
+            makedirs(os.path.dirname(dst_ext_firmware_path))
+            # Link or copy the firmware file.
+            size += materializer.copy_file(
+               os.path.join(src_firmware_path, src_ext_firmware_path),
+               dst_ext_firmware_path
+            )
+            firmware_packages['lib/firmware/' + src_ext_firmware_path] = \
+               package
+      self._events.emit(
+         'copy', step='out-of-tree firmware', variant=None,
+         files=len(firmware_packages), bytes=size
+      )
+      if profiler:
+         profiler.add_step('out-of-tree firmware', firmware_packages)
+      del firmware_packages
+
+      if len(self._irf_variants) == 1:
+         # Build the only variant in place.
+         variant, irf_source_path = next(iter(self._irf_variants.items()))
+         archive_paths = [self.build_initramfs_variant(
+            variant, irf_source_path, irf_base_path, debug, profiler,
+            profile_path
+         )]
+      else:
+         # Give each variant its own copy of the shared files, linking them
+         # rather than copying them whenever possible.
+         variant_args = []
+         for variant, irf_source_path in self._irf_variants.items():
+            # Named variants get a “-” suffix, so they can’t collide with the
+            # default one.
+            irf_work_path = irf_base_path + (
+               '-' + variant if variant else '.default'
+            )
+            if os.path.isdir(irf_work_path):
+               shutil.rmtree(irf_work_path)
+            files, size = materializer.copy_tree(
+               irf_base_path, irf_work_path
+            )
+            self._events.emit(
+               'copy', step='initramfs variant', variant=variant,
+               files=files, bytes=size
+            )
+            variant_args.append((
+               variant, irf_source_path, irf_work_path, debug,
+               profiler and profiler.copy(irf_work_path), profile_path
+            ))
+         shutil.rmtree(irf_base_path)
+         indent = self._thread_state.indent
+
+         def build_variant(args):
+            self._thread_state.indent = indent
+            return self.build_initramfs_variant(*args)
+
+         pool = multiprocessing.pool.ThreadPool(
+            min(len(variant_args), online_cpus())
          )
+         try:
+            archive_paths = pool.map(build_variant, variant_args)
+         finally:
+            pool.close()
+            pool.join()
 
-      irf_build_path = os.path.join(self._irf_source_path, 'build')
-      if os.path.isfile(irf_build_path) and \
-         os.access(irf_build_path, os.R_OK | os.X_OK) \
-      :
+      self.eoutdent()
+      return archive_paths
+
+   def build_initramfs_variant(
+      self, variant, irf_source_path, irf_work_path, debug, profiler,
+      profile_path
+   ):
+      """Completes an initramfs variant from its source, starting from the
+      kernel modules and firmware staged by build_initramfs(), then archives
+      it and removes its working directory.
+
+      str variant
+         Name of the variant, or None for the default initramfs.
+      str irf_source_path
+         Path to the initramfs source directory.
+      str irf_work_path
+         Directory in which the initramfs will be built.
+      bool debug
+         If True, the contents of the generated initramfs will be dumped to a
+         file for later inspection.
+      InitramfsProfiler profiler
+         Profiler tracking irf_work_path, or None.
+      str profile_path
+         If profiler is not None, path to the JSON profile to write.
+      str return
+         Path to the generated archive.
+      """
+
+      if variant:
+         name_suffix = '-' + variant
+         log_prefix = variant + ': '
+      else:
+         name_suffix = ''
+         log_prefix = ''
+
+      irf_build_path = self.initramfs_build_program(irf_source_path)
+      if irf_build_path:
          # The initramfs has a build script; invoke it.
-         self.einfo('Invoking initramfs custom build script')
-         self.eindent()
+         self.einfo(log_prefix + 'Invoking initramfs custom build script')
          irf_build_env = dict(os.environ)
          irf_build_env['ARCH'] = self._kmake_env['ARCH']
          if self._cross_compiler_prefix:
             irf_build_env['CROSS_COMPILE'] = self._cross_compiler_prefix
+         if variant:
+            irf_build_env['INITRAMFS_VARIANT'] = variant
          irf_build_env['PORTAGE_ARCH'] = self._portage_config['ARCH']
-         try:
-            subprocess.check_call((irf_build_path, ), env = irf_build_env)
-         finally:
-            self.eoutdent()
+         with self._events.process((irf_build_path, )):
+            subprocess.check_call(
+               (irf_build_path, ), env=irf_build_env, cwd=irf_work_path
+            )
          del irf_build_env
       else:
          # No build script; just copy every file.
-         self.einfo('Adding source files')
-         for irf_file in os.listdir(self._irf_source_path):
-            shutil.copytree(
-               os.path.join(self._irf_source_path, irf_file), irf_work_path
+         self.einfo(log_prefix + 'Adding source files')
+         files, size = self._materializer.copy_tree(
+            irf_source_path, irf_work_path
+         )
+         self._events.emit(
+            'copy', step='initramfs source', variant=variant, files=files,
+            bytes=size
+         )
+      self.einfo(log_prefix + 'Updating kernel module indexes')
+      self.rebuild_module_indexes(irf_work_path)
+      if profiler:
+         # The build script may have copied out-of-tree modules from ${ROOT};
+         # attribute them to their packages.
+         module_prefix = 'lib/modules/{}/'.format(self._kernel_release)
+         module_packages = {}
+         for package, files in \
+            self.out_of_tree_enumerator().packages_and_files(
+               use_slot=False, firmware=False,
+               kernel_release=self._kernel_release
+            ) \
+         :
+            for module_path in files:
+               module_packages[module_prefix + module_path] = package
+         profiler.add_step('initramfs source', module_packages)
+         del module_packages
+
+      # Store each distinct file body in the archive only once.
+      files, size = self._materializer.deduplicate_tree(irf_work_path)
+      if files:
+         self.einfo(log_prefix + (
+            'Replaced {} duplicate files with hardlinks, saving {} KiB'
+         ).format(files, size // 1024))
+      self._events.emit(
+         'deduplicate', variant=variant, files=files, bytes=size
+      )
+      cpio_input_bytes = self.list_initramfs_contents(
+         irf_work_path, debug, variant
+      )
+      if profiler:
+         if variant:
+            profile_path_root, profile_path_ext = os.path.splitext(
+               profile_path
             )
+            profile_path = profile_path_root + name_suffix + profile_path_ext
+         self.einfo(log_prefix + 'Writing initramfs profile to {}'.format(
+            profile_path
+         ))
+         profiler.write_json(profile_path)
+         profiler = None
+      if self._irf_compression_policy:
+         # Create the uncompressed archive once, to benchmark compressors on
+         # it and then compress it with the selected one. Keep it in the
+         # package build directory, out of ${D}.
+         cpio_path = os.path.join(
+            os.path.dirname(self._ebuild_pkg_root.rstrip('/')),
+            'initramfs{}.cpio'.format(name_suffix)
+         )
+         with open(cpio_path, 'wb') as cpio_file:
+            self.run_cpio(cpio_file, irf_work_path)
+         with self._irf_compression_lock:
+            compressor = self.select_initramfs_compressor(cpio_path)
+      else:
+         cpio_path = None
+         compressor = self._irf_compressor
+      archive_path = os.path.join(
+         self._ebuild_pkg_root, 'boot/initramfs-{}{}.cpio{}'.format(
+            self._kernel_release, name_suffix, compressor.file_name_ext()
+         )
+      )
+      self.create_initramfs_archive(
+         cpio_input_bytes, irf_work_path, archive_path, compressor, cpio_path
+      )
+      self._events.emit(
+         'archive', variant=variant, path=archive_path,
+         compressor=compressor.config_name(),
+         files=cpio_input_bytes.count(b'\0'),
+         bytes=os.path.getsize(archive_path),
+         uncompressed_bytes=cpio_path and os.path.getsize(cpio_path)
+      )
+      if cpio_path:
+         os.unlink(cpio_path)
 
-      cpio_input_bytes = self.list_initramfs_contents(irf_work_path, debug)
-      self.create_initramfs_archive(cpio_input_bytes)
-
-      # Get out of and remove the working directory, to avoid including it in
-      # the binary package.
-      os.chdir(prev_cwd)
+      # Remove the working directory, to avoid including it in the binary
+      # package.
       shutil.rmtree(irf_work_path)
+      return archive_path
 
-      self.eoutdent()
-
-   def build_kernel(self, rebuild_out_of_tree_modules = True):
+   @event_phase('kernel')
+   def build_kernel(
+      self, rebuild_out_of_tree_modules = True, force_out_of_tree = False
+   ):
       """Builds the kernel image and modules.
 
       bool rebuild_out_of_tree_modules
          If True, packages that provide out-of-tree modules will be rebuilt in
          order to ensure binary compatibility with the kernel being built.
+      bool force_out_of_tree
+         If True, all packages that provide out-of-tree modules will be
+         rebuilt; otherwise, only those whose modules were not built for the
+         same release and vermagic as the kernel being built.
       """
 
       self.einfo('Ready to build:')
@@ -344,12 +863,20 @@ class Generator(object):
       ))
       self.einfo('from \033[1;37m{}\033[0m'.format(self._source_path))
 
-      if self._irf_source_path:
+      for variant, irf_source_path in self._irf_variants.items():
          # Check that a valid initramfs directory was specified.
-         self._irf_source_path = os.path.realpath(self._irf_source_path)
-         self.einfo('with initramfs from \033[1;37m{}\033[0m'.format(
-            self._irf_source_path
-         ))
+         irf_source_path = os.path.realpath(irf_source_path)
+         self._irf_variants[variant] = irf_source_path
+         if variant:
+            self.einfo(
+               'with initramfs {} from \033[1;37m{}\033[0m'.format(
+                  variant, irf_source_path
+               )
+            )
+         else:
+            self.einfo('with initramfs from \033[1;37m{}\033[0m'.format(
+               irf_source_path
+            ))
       if self._cross_compiler_prefix:
          self.einfo(
             'cross-compiled with \033[1;37m{}\033[0m toolchain'
@@ -380,37 +907,126 @@ class Generator(object):
          os.path.getmtime(self._src_config_path) > \
          os.path.getmtime(self._src_image_path) \
       :
-         if rebuild_out_of_tree_modules:
-            self.einfo('Preparing to rebuild out-of-tree kernel modules')
-            self.kmake_check_call('modules_prepare')
-
-            self.einfo('Getting a list of out-of-tree kernel modules')
-            oote = OutOfTreeEnumerator(firmware=False, modules=True)
-            self._module_packages = tuple(oote.packages())
-            if self._module_packages:
-               self.einfo('Rebuilding out-of-tree kernel modules\' packages')
-               # First make sure that all the modules’ dependencies are
-               # installed.
-               self.emerge_check_call(None,
-                  '--changed-use', '--onlydeps', '--update',
-                  *self._module_packages
+         restored = False
+         if self._artifact_cache:
+            cache_inputs = self.artifact_cache_inputs()
+            # The entry can’t be evicted while it’s being restored.
+            with self._artifact_cache.lookup(
+               ArtifactCache.key(cache_inputs)
+            ) as cache_entry_path:
+               if cache_entry_path:
+                  self.einfo(
+                     'Restoring kernel image and in-tree modules from ' +
+                     'artifact cache'
+                  )
+                  self.restore_kernel_artifacts(cache_entry_path)
+                  restored = True
+         if not restored:
+            if os.path.isdir(self._cached_modules_path):
+               # Restored by a previous run; the modules built now replace
+               # them.
+               shutil.rmtree(self._cached_modules_path)
+            self.einfo('Building kernel image and in-tree modules')
+            if self._compile_profile_path:
+               compile_profiler = CompileProfiler(
+                  os.path.join(self._state_path, 'compile-profile.log'),
+                  self._source_path
                )
-               # Then (re)build the modules, but only generate their binary
-               # packages.
-               emerge_env = dict(os.environ)
-               emerge_env['KERNEL_DIR'] = self._source_path
-               self.emerge_check_call(emerge_env,
-                  '--buildpkgonly', '--usepkg=n', *self._module_packages
+               compile_profiler.clear()
+               self.kmake_check_call(
+                  'CC=' + compile_profiler.wrap_cc(self.kernel_cc())
+               )
+               self.report_compile_profile(compile_profiler)
+               del compile_profiler
+            else:
+               self.kmake_check_call()
+            if self._artifact_cache:
+               self.einfo(
+                  'Storing kernel image and in-tree modules in artifact cache'
+               )
+               self._artifact_cache.store(
+                  cache_inputs, self.store_kernel_artifacts
                )
-               del emerge_env
-
-         self.einfo('Building kernel image and in-tree modules')
-         self.kmake_check_call()
 
          # Touch the kernel image now, to avoid always re-running kmake (see
          # large comment above).
          os.utime(self._src_image_path, None)
+         self._checkpoints.mark('kernel')
+
+      # Out-of-tree modules are rebuilt after the kernel, so that they can be
+      # built against its Module.symvers, and so that the vermagic of its
+      # in-tree modules can be used to tell which packages need rebuilding.
+      # That check, rather than whether this run built the kernel, decides
+      # what to rebuild, so that a rebuild that failed after the kernel was
+      # built is retried by the next run.
+      oot_checkpoint = self._checkpoints.get('oot_modules')
+      if oot_checkpoint is not None:
+         self._module_packages = tuple(oot_checkpoint['packages'])
+      if rebuild_out_of_tree_modules:
+         if oot_checkpoint is not None:
+            self.einfo(
+               'Out-of-tree kernel modules\' packages already rebuilt'
+            )
+         else:
+            self.einfo('Getting a list of out-of-tree kernel modules')
+            self._module_packages = tuple(
+               self.stale_module_packages(force_out_of_tree)
+            )
+            if self._module_packages:
+               self.einfo('Rebuilding out-of-tree kernel modules\' packages')
+               self.rebuild_module_packages(self._module_packages)
+            self._checkpoints.mark(
+               'oot_modules', packages=list(self._module_packages)
+            )
+
+   def compute_make_jobs(self):
+      """Sizes the make job budget according to the settings passed to
+      set_make_jobs(), replacing any -j/-l options from ${MAKEOPTS} in the
+      make command line.
 
+      list(str*) return
+         make options setting the number of jobs and the load limit.
+      """
+
+      jobs_args, self._kmake_args = split_make_jobs_args(self._kmake_args)
+      if self._make_jobs == 'makeopts':
+         # Keep the options from ${MAKEOPTS}.
+         return jobs_args
+
+      cpus = online_cpus()
+      if self._make_load_average is None:
+         load_average = float(cpus)
+      else:
+         load_average = self._make_load_average
+      if self._make_jobs != 'auto':
+         jobs = self._make_jobs
+      else:
+         # Use CPUs not already kept busy by other processes.
+         busy_cpus = int(os.getloadavg()[0])
+         local_jobs = max(1, cpus - busy_cpus)
+         if 'distcc' in self._portage_config.features:
+            remote_jobs = self.distcc_remote_slots()
+         else:
+            remote_jobs = 0
+         # Don’t run more jobs than can fit in the available memory.
+         mem_available = meminfo().get('MemAvailable', 0)
+         if self._build_tmpfs_mounted:
+            # The tmpfs only takes up memory as the build fills it, so keep
+            # its free space out of the jobs’ budget.
+            tmpfs_stat = os.statvfs(self._build_path)
+            mem_available = max(
+               0, mem_available - tmpfs_stat.f_bavail * tmpfs_stat.f_frsize
+            )
+         mem_jobs = max(1, mem_available // self._make_job_memory)
+         jobs = max(1, min(local_jobs + remote_jobs, mem_jobs))
+         self.einfo(
+            'Using {} make jobs ({} idle CPUs, {} distcc slots, '.format(
+               jobs, local_jobs, remote_jobs
+            ) + '{} MiB of available memory)'.format(mem_available >> 20)
+         )
+      return ['-j{}'.format(jobs), '-l{:g}'.format(load_average)]
+
+   @event_phase('ebuild')
    def create_ebuild(self, overlay_name = None):
       """Creates the temporary ebuild from which a binary package will be
       created later.
@@ -444,66 +1060,131 @@ class Generator(object):
             self._package_name, self._package_version
          )
       )
+      ebuild_checkpoint = self._checkpoints.get('ebuild')
+      if ebuild_checkpoint is not None and \
+         ebuild_checkpoint['ebuild_file_path'] == self._ebuild_file_path and \
+         os.path.isfile(self._ebuild_file_path) and \
+         os.path.isdir(ebuild_checkpoint['pkg_root']) \
+      :
+         self.einfo('Resuming with the existing temporary ebuild')
+         self._ebuild_pkg_root = ebuild_checkpoint['pkg_root']
+         return
+      if self._resume:
+         self._checkpoints.invalidate('ebuild')
+      else:
+         # Forget about any previous run.
+         self._checkpoints.delete()
       with open(self._ebuild_file_path, 'wt') as ebuild_file:
          ebuild_file.write(self._ebuild_template)
 
       # Have Portage create the package installation image for the ebuild. The
       # ebuild will output the destination path, ${D}, using a pattern
       # specific to kernel-gen.
-      out = subprocess.check_output(
+      matches = self.logged_check_call(
          ('ebuild', self._ebuild_file_path, 'clean', 'manifest', 'install'),
-         stderr=subprocess.STDOUT, universal_newlines=True
+         markers={'D': re.compile(r'^KERNEL-GEN: D=(?P<D>.*)$')}
+      )
+      if not matches['D']:
+         self.eerror('The ebuild did not report its destination path')
+         raise GeneratorError()
+      self._ebuild_pkg_root = matches['D'].group('D')
+      self._checkpoints.mark(
+         'ebuild', ebuild_file_path=self._ebuild_file_path,
+         pkg_root=self._ebuild_pkg_root
       )
-      match = re.search(r'^KERNEL-GEN: D=(?P<D>.*)$', out, re.MULTILINE)
-      self._ebuild_pkg_root = match.group('D')
 
-   def create_initramfs_archive(self, cpio_input_bytes):
-      """Creates a cpio archive containing the contents of the initramfs,
-      named self._irf_archive_path.
+   def create_initramfs_archive(
+      self, cpio_input_bytes, irf_work_path, archive_path, compressor,
+      cpio_path = None
+   ):
+      """Creates a compressed cpio archive containing the contents of the
+      initramfs.
 
       bytes cpio_input_bytes
          NUL-delimited list of file paths.
+      str irf_work_path
+         Directory in which the initramfs has been built.
+      str archive_path
+         Path to the archive to create.
+      Compressor compressor
+         Compressor to use.
+      str cpio_path
+         Path to an already created, uncompressed cpio archive to compress;
+         if None, the archive will be created from irf_work_path.
       """
 
-      self.einfo('Creating archive')
-      with open(self._irf_archive_path, 'wb') as irf_archive_file:
+      self.einfo('Creating archive {}'.format(os.path.basename(archive_path)))
+      with open(archive_path, 'wb') as irf_archive_file:
+         if cpio_path:
+            with open(cpio_path, 'rb') as cpio_file:
+               with self._events.process(compressor.cmd_args()):
+                  subprocess.check_call(
+                     compressor.cmd_args(),
+                     stdin=cpio_file, stdout=irf_archive_file
+                  )
+            return
          # Spawn the compressor or just a cat.
-         compress_proc = subprocess.Popen(
-            self._irf_compressor.cmd_args(),
-            stdin=subprocess.PIPE, stdout=irf_archive_file
-         )
-         # Make cpio write to the compressor’s input, and redirect its stderr
-         # to /dev/null since it likes to output junk.
-         cpio_proc = subprocess.Popen(
-            ('cpio', '--create', '--format=newc', '--null', '--owner=0:0'),
-            stdin=subprocess.PIPE,
-            stdout=compress_proc.stdin, stderr=self._dev_null
-         )
-#         # Send cpio the list of files to package.
-#         cpio_proc.communicate(cpio_input_bytes)
-         # Use find . to enumerate the files for cpio to pack.
-         find_proc = subprocess.Popen(
-            ('find', '.', '-print0'), stdout=cpio_proc.stdin
-         )
+         with self._events.process(compressor.cmd_args()) as status:
+            compress_proc = subprocess.Popen(
+               compressor.cmd_args(),
+               stdin=subprocess.PIPE, stdout=irf_archive_file
+            )
+#            # Send cpio the list of files to package.
+#            cpio_proc.communicate(cpio_input_bytes)
+            self.run_cpio(compress_proc.stdin, irf_work_path)
+            compress_proc.communicate()
+            status['returncode'] = compress_proc.returncode
+
+   def distcc_remote_slots(self):
+      """Counts the jobs that can be run on remote distcc hosts, as per
+      ${DISTCC_HOSTS} or the distcc hosts file.
+
+      int return
+         Total job limit of non-local distcc hosts.
+      """
 
-         find_proc.communicate()
-         cpio_proc.communicate()
-         compress_proc.communicate()
+      hosts = os.environ.get('DISTCC_HOSTS')
+      if hosts is None:
+         for hosts_file_path in (
+            os.path.join(os.path.expanduser('~'), '.distcc/hosts'),
+            os.path.join(self._root, 'etc/distcc/hosts'),
+         ):
+            if os.path.isfile(hosts_file_path):
+               with open(hosts_file_path, 'r') as hosts_file:
+                  hosts = ' '.join(
+                     line.split('#', 1)[0] for line in hosts_file
+                  )
+               break
+         else:
+            return 0
+      ret = 0
+      for host in hosts.split():
+         if host.startswith(('-', '+')):
+            # Option or zeroconf; ignore it.
+            continue
+         host_name = re.split(r'[/:,]', host.lstrip('@'), 1)[0]
+         if host_name == 'localhost':
+            # Local jobs are already accounted for.
+            continue
+         match = re.search(r'/(\d+)', host)
+         # distcc defaults to 4 jobs per remote host.
+         ret += int(match.group(1)) if match else 4
+      return ret
 
    def eerror(self, s):
       """TODO: comment"""
 
-      print(self._indent + '[E] ' + s)
+      self._events.message('error', s, len(self._thread_state.indent) // 2)
 
    def eindent(self):
       """TODO: comment"""
 
-      self._indent += '  '
+      self._thread_state.indent += '  '
 
    def einfo(self, s):
       """TODO: comment"""
 
-      print(self._indent + '[I] ' + s)
+      self._events.message('info', s, len(self._thread_state.indent) // 2)
 
    def emerge_check_call(self, env, *args):
       """Invokes emerge in “quiet” mode with the specified additional command-
@@ -523,50 +1204,219 @@ class Generator(object):
       else:
          all_args.extend(('--quiet', '--quiet-build', '--quiet-fail=y'))
       all_args.extend(args)
-      subprocess.check_call(
-         all_args, env=env, stdout=(None if verbose else self._dev_null)
-      )
+      env = self.emerge_env(env)
+      if verbose:
+         with self._events.process(all_args):
+            subprocess.check_call(all_args, env=env)
+      else:
+         self.logged_check_call(all_args, env=env)
+
+   def emerge_env(self, env = None):
+      """Returns the environment for emerge, making ebuilds use the same make
+      job budget as the kernel.
+
+      dict(str: str) env
+         Environment variable dictionary to use in place of os.environ; if
+         None, os.environ will be used.
+      dict(str: str) return
+         Environment variable dictionary for emerge.
+      """
+
+      if self._make_jobs_args is None:
+         return env
+      env = dict(env or os.environ)
+      env['MAKEOPTS'] = ' '.join(split_make_jobs_args(
+         shlex.split(self._portage_config['MAKEOPTS'])
+      )[1] + self._make_jobs_args)
+      return env
 
    def eoutdent(self):
       """TODO: comment"""
 
-      self._indent = self._indent[:-2]
+      self._thread_state.indent = self._thread_state.indent[:-2]
+
+   def events(self):
+      """Returns the stream of progress events, to which library callers can
+      subscribe to monitor a run.
+
+      kerneltools.EventStream.EventStream return
+         Event stream.
+      """
+
+      return self._events
 
    def ewarn(self, s):
       """TODO: comment"""
 
-      print(self._indent + '[W] ' + s)
+      self._events.message('warning', s, len(self._thread_state.indent) // 2)
+
+   def initramfs_build_program(self, irf_source_path):
+      """Returns the build program of an initramfs source directory, if it has
+      one.
+
+      str irf_source_path
+         Path to the initramfs source directory.
+      str return
+         Path to the build program, or None if the source directory has none
+         and its contents are to be copied as-is.
+      """
+
+      irf_build_path = os.path.join(irf_source_path, 'build')
+      if os.path.isfile(irf_build_path) and \
+         os.access(irf_build_path, os.R_OK | os.X_OK) \
+      :
+         return irf_build_path
+      return None
+
+   def install_modules(self, root_path, materializer = None):
+      """Installs the in-tree kernel modules into a directory, like
+      “make modules_install”; if the kernel was restored from the artifact
+      cache, the restored modules are used instead.
+
+      str root_path
+         Directory that will contain lib/modules/<kernel release>.
+      FileMaterializer materializer
+         Used to stage restored modules; defaults to one that hardlinks them
+         whenever possible.
+      """
+
+      if os.path.isdir(self._cached_modules_path):
+         files, size = (materializer or self._materializer).copy_tree(
+            self._cached_modules_path, root_path
+         )
+         self._events.emit(
+            'copy', step='cached modules', variant=None, files=files,
+            bytes=size
+         )
+      else:
+         self.kmake_check_call(
+            'INSTALL_MOD_PATH=' + root_path, 'modules_install'
+         )
 
+   @event_phase('install')
    def install(self, include_out_of_tree_modules = True):
-      """Installs the generated kernel binary package.
+      """Installs the generated kernel binary package and, optionally, the
+      binary packages of the out-of-tree modules, in a single merge.
 
       bool include_out_of_tree_modules
          If True, also install packages that provide out-of-tree modules.
       """
 
-      self.einfo(
-         'Installing kernel binary package \033[1;35m{}/{}-{}\033[0m'.format(
-            self._category, self._package_name, self._package_version
-         )
-      )
-      self.emerge_check_call(
-         None, '--select', '--usepkgonly=y', '={}/{}-{}'.format(
-            self._category, self._package_name, self._package_version
-         )
+      kernel_atom = '={}/{}-{}'.format(
+         self._category, self._package_name, self._package_version
       )
       if include_out_of_tree_modules:
          if self._module_packages is None:
             # build_kernel() hasn’t been called, so we need to scan for
             # out-of-tree modules now.
-            oote = OutOfTreeEnumerator(firmware=False, modules=True)
-            self._module_packages = tuple(oote.packages())
-         if self._module_packages:
-            self.einfo(
-               'Installing out-of-tree kernel modules\' binary packages'
+            self._module_packages = tuple(
+               self.out_of_tree_enumerator().packages(firmware=False)
             )
+         module_packages = list(self._module_packages)
+      else:
+         module_packages = []
+      if module_packages:
+         self.einfo((
+            'Installing kernel binary package \033[1;35m{}\033[0m and ' +
+            'out-of-tree kernel modules\' binary packages'
+         ).format(kernel_atom[1:]))
+      else:
+         self.einfo(
+            'Installing kernel binary package \033[1;35m{}\033[0m'.format(
+               kernel_atom[1:]
+            )
+         )
+
+      kernel_cp = portage_dep.Atom(kernel_atom).cp
+
+      def plan(tasks, favorites):
+         # Merge everything at once, in the order required by dependencies,
+         # but only add the kernel to the world set.
+         return ((
+            tasks, {},
+            [
+               favorite for favorite in favorites
+               if getattr(favorite, 'cp', None) == kernel_cp
+            ],
+            None, 'Merging {} binary packages'
+         ),)
+
+      if self._cross_compiler_prefix or not self.resolve_and_merge(
+         ['--select', '--usepkgonly=y', kernel_atom] + module_packages, plan
+      ):
+         if not module_packages:
             self.emerge_check_call(
-               None, '--oneshot', '--usepkgonly=y', *self._module_packages
+               None, '--select', '--usepkgonly=y', kernel_atom
             )
+            return
+         # emerge can’t select only some of the atoms it merges, so merge
+         # everything without selecting anything, then add the kernel to the
+         # world set, which doesn’t merge it again.
+         self.emerge_check_call(
+            None, '--oneshot', '--usepkgonly=y', kernel_atom, *module_packages
+         )
+         self.emerge_check_call(None, '--noreplace', '--select', kernel_atom)
+
+   def kernel_cc(self):
+      """Returns the compiler command that kmake will use to build the kernel.
+
+      str return
+         Compiler command, including any wrapper such as distcc.
+      """
+
+      for arg in reversed(self._kmake_args):
+         if arg.startswith('CC='):
+            return arg[len('CC='):]
+      if 'CONFIG_CC_IS_CLANG' in self.load_kernel_config() or \
+         'LLVM=1' in self._kmake_args \
+      :
+         cc = 'clang'
+      else:
+         cc = 'gcc'
+      return (self._cross_compiler_prefix or '') + cc
+
+   def kernel_vermagic(self):
+      """Reads the vermagic of the kernel just built from one of its in-tree
+      modules.
+
+      str return
+         Vermagic string, or None if the kernel has no modules or its first
+         module has no vermagic.
+      """
+
+      if os.path.isdir(self._cached_modules_path):
+         # Restored from the artifact cache, which only has installed modules.
+         modules_path = os.path.join(
+            self._cached_modules_path, 'lib/modules', self._kernel_release
+         )
+      else:
+         modules_path = self._kbuild_output_path
+      order_path = os.path.join(modules_path, 'modules.order')
+      if not os.path.isfile(order_path):
+         return None
+      with open(order_path, 'r') as order_file:
+         for module_path in order_file.read().splitlines():
+            # Newer kernels list the objects the modules are linked from in
+            # the build directory’s modules.order.
+            module_path = re.sub(r'\.o$', '.ko', module_path)
+            # Older kernels list modules with a “kernel/” prefix, which only
+            # applies to installed modules.
+            for rel_path in (
+               module_path, re.sub(r'^kernel/', '', module_path)
+            ):
+               file_path = os.path.join(modules_path, rel_path)
+               for ext in self._module_file_exts:
+                  if os.path.isfile(file_path + ext):
+                     break
+               else:
+                  continue
+               vermagic = ModuleInfo(file_path + ext).get('vermagic')
+               if vermagic is None:
+                  self.ewarn(
+                     'Module {} has no vermagic'.format(rel_path + ext)
+                  )
+               return vermagic
+      return None
 
    def kmake_call_kernelversion(self):
       """Retrieves the kernel version for the source directory specified in
@@ -578,14 +1428,17 @@ class Generator(object):
 
       # Ignore errors; if no source directory can be found, we’ll take care of
       # failing.
-      make_proc = subprocess.Popen(
-         self._kmake_args + [
-            '--directory', self._source_path, '--quiet', 'kernelversion'
-         ],
-         env=self._kmake_env, stdout=subprocess.PIPE, stderr=self._dev_null,
-         universal_newlines=True
-      )
-      ret = make_proc.communicate()[0].rstrip()
+      make_args = self._kmake_args + [
+         '--directory', self._source_path, '--quiet', 'kernelversion'
+      ]
+      with self._events.process(make_args) as status:
+         make_proc = subprocess.Popen(
+            make_args, env=self._kmake_env,
+            stdout=subprocess.PIPE, stderr=self._dev_null,
+            universal_newlines=True
+         )
+         ret = make_proc.communicate()[0].rstrip()
+         status['returncode'] = make_proc.returncode
       # Expect a single line; if multiple lines are present, they must be
       # errors.
       if make_proc.returncode == 0 and '\n' not in ret:
@@ -603,9 +1456,7 @@ class Generator(object):
       all_args = list(self._kmake_args)
       all_args.append('--quiet')
       all_args.extend(args)
-      subprocess.check_output(
-         all_args, env=self._kmake_env
-      )
+      self.logged_check_call(all_args, env=self._kmake_env)
 
    def kmake_check_output(self, target):
       """Runs kmake to build the specified informative target, such as
@@ -620,26 +1471,28 @@ class Generator(object):
       all_args = list(self._kmake_args)
       all_args.append('--quiet')
       all_args.append(target)
-      ret = subprocess.check_output(
-         all_args, env=self._kmake_env,
-         stderr=subprocess.STDOUT, universal_newlines=True
-      ).rstrip()
+      with self._events.process(all_args):
+         ret = subprocess.check_output(
+            all_args, env=self._kmake_env,
+            stderr=subprocess.STDOUT, universal_newlines=True
+         ).rstrip()
       if '\n' in ret:
          self.eerror('Unexpected output by make {}:'.format(target))
          self.eerror(ret)
          raise GeneratorError()
       return ret
 
-   def list_initramfs_contents(self, irf_work_path, debug):
+   def list_initramfs_contents(self, irf_work_path, debug, variant = None):
       """Builds a list with every file path that cpio should package, relative
       to irf_work_path.
 
       str irf_work_path
-         Temporary directory in which the initramfs image has been built; this
-         is also the current directory.
+         Temporary directory in which the initramfs image has been built.
       bool debug
          If True, the contents of the generated initramfs will be dumped to a
          file for later inspection.
+      str variant
+         Name of the initramfs variant, or None for the default initramfs.
       bytes return
          NUL-delimited list of file paths.
       """
@@ -657,19 +1510,22 @@ class Generator(object):
       if debug:
          irf_dump_file_path = os.path.join(
             os.environ.get('TMPDIR', '/tmp'),
-            'initramfs-' + self._kernel_release + '.ls'
+            'initramfs-' + self._kernel_release +
+               ('-' + variant if variant else '') + '.ls'
          )
          with open(irf_dump_file_path, 'w') as irf_dump_file:
             self.einfo('Dumping contents of generated initramfs to {}'.format(
                irf_dump_file_path
             ))
-            subprocess.check_call(
-               ['ls', '-lR', '--color=always'] + irf_contents,
-               stdout=irf_dump_file, universal_newlines=True
-            )
-#      return b'\0'.join(
-#         bytes(path, encoding='utf-8') for path in irf_contents
-#      )
+            ls_args = ['ls', '-lR', '--color=always'] + irf_contents
+            with self._events.process(ls_args):
+               subprocess.check_call(
+                  ls_args, stdout=irf_dump_file, universal_newlines=True,
+                  cwd=irf_work_path
+               )
+      return b'\0'.join(
+         path.encode('utf-8') for path in irf_contents
+      ) + b'\0'
 
    def load_kernel_config(self):
       """Loads the selected kernel configuration file (.config), storing the
@@ -692,9 +1548,14 @@ class Generator(object):
                   self.eerror(
                      'This kernel needs to be configured first; try:'
                   )
-                  self.eerror('  make -C \'{}\' nconfig'.format(
-                     self._source_path
-                  ))
+                  if self._build_path:
+                     self.eerror('  make -C \'{}\' O=\'{}\' nconfig'.format(
+                        self._source_path, self._build_path
+                     ))
+                  else:
+                     self.eerror('  make -C \'{}\' nconfig'.format(
+                        self._source_path
+                     ))
                   raise GeneratorError()
 
                match = re.match(
@@ -728,6 +1589,43 @@ class Generator(object):
                   kernel_config[match.group('name')] = value
       return kernel_config
 
+   def logged_check_call(self, args, env = None, markers = None):
+      """Runs a program, streaming its output to the output log instead of
+      keeping it in memory; on failure, the last lines of output are
+      displayed.
+
+      iterable(str*) args
+         Program and arguments.
+      dict(str: str) env
+         Environment variable dictionary to use in place of os.environ; if
+         None, os.environ will be used.
+      dict(str: re) markers
+         Regular expressions to match against each output line, by name.
+      dict(str: re.Match) return
+         First match for each marker, or None for markers that never matched.
+      """
+
+      def on_line(line):
+         self._events.emit('process_output', line=line)
+
+      try:
+         with self._events.process(args):
+            return self._output_log.check_call(
+               args, env=env, markers=markers, on_line=on_line
+            )
+      except subprocess.CalledProcessError as x:
+         self.eerror('Command failed with exit status {}: {}'.format(
+            x.returncode, ' '.join(args)
+         ))
+         self.eindent()
+         for line in self._output_log.tail():
+            self.eerror(line)
+         self.eoutdent()
+         self.eerror('Full output in `{}\''.format(
+            self._output_log.file_path()
+         ))
+         raise GeneratorError()
+
    def make_package_name(self, kernel_config):
       """Generates category, name and version for the binary package that will
       be generated.
@@ -750,66 +1648,716 @@ class Generator(object):
       # Build the package name with version.
       self._package_version = match.group('ver') + (match.group('rev') or '')
 
-   def package(self, irf_debug = False):
+   def out_of_tree_enumerator(self):
+      """Returns an enumerator of the out-of-tree modules and firmware
+      installed in ${ROOT}, scanning the VDB the first time it’s called; all
+      phases share the results of this single scan, since none of them
+      changes the packages installed until install() is done with it.
+
+      kerneltools.OutOfTreeEnumerator.OutOfTreeEnumerator return
+         Enumerator, ready to be queried with packages_and_files().
+      """
+
+      if self._oot_enumerator is None:
+         self._oot_enumerator = OutOfTreeEnumerator(
+            firmware=True, modules=True
+         )
+         self._oot_enumerator.scan()
+      return self._oot_enumerator
+
+   @event_phase('package')
+   def package(self, irf_debug = False, irf_profile_path = None):
       """Generates a Portage binary package (.tbz2) containing the kernel
       image, in-tree modules, and optional initramfs.
 
       bool irf_debug
          If True, the contents of the generated initramfs will be dumped to a
          file for later inspection.
+      str irf_profile_path
+         If not None, a JSON profile of the size and origin of each file in
+         the initramfs will be written to this file.
       """
 
       # Inject the package contents into ${D}.
 
-      self.einfo('Adding kernel image')
-      os.mkdir(os.path.join(self._ebuild_pkg_root, 'boot'))
-      shutil.copy2(self._src_config_path, os.path.join(
-         self._ebuild_pkg_root, 'boot/config-' + self._kernel_release
-      ))
-      shutil.copy2(
-         os.path.join(self._source_path, 'System.map'),
-         os.path.join(
-            self._ebuild_pkg_root, 'boot/System.map-' + self._kernel_release
+      boot_path = os.path.join(self._ebuild_pkg_root, 'boot')
+      if self._checkpoints.done('modules') and os.path.isfile(
+         os.path.join(boot_path, 'linux-' + self._kernel_release)
+      ):
+         self.einfo('Kernel image and modules already added')
+      else:
+         if os.path.isdir(boot_path):
+            # Left over by a failed run that is being resumed.
+            shutil.rmtree(boot_path)
+         self.einfo('Adding kernel image')
+         os.mkdir(boot_path)
+         size = self._materializer.copy_file(
+            self._src_config_path,
+            os.path.join(boot_path, 'config-' + self._kernel_release)
+         )
+         size += self._materializer.copy_file(
+            os.path.join(self._kbuild_output_path, 'System.map'),
+            os.path.join(boot_path, 'System.map-' + self._kernel_release)
          )
+         size += self._materializer.copy_file(
+            self._src_image_path,
+            os.path.join(boot_path, 'linux-' + self._kernel_release)
+         )
+         self._events.emit(
+            'copy', step='kernel image', variant=None, files=3, bytes=size
+         )
+         # Create a symlink for compatibility with GRUB’s /etc/grub.d/10_linux
+         # detection script.
+         os.symlink('linux-' + self._kernel_release, os.path.join(
+            boot_path, 'kernel-' + self._kernel_release
+         ))
+
+         self.einfo('Adding modules')
+         self.install_modules(self._ebuild_pkg_root)
+         self._checkpoints.mark('modules')
+
+      if self._irf_variants:
+         # Changes to the source directories prevent resuming, but not changes
+         # to any other file that build programs might use.
+         irf_sources = [
+            [variant, irf_source_path, tree_digest(irf_source_path)]
+            for variant, irf_source_path in self._irf_variants.items()
+         ]
+         irf_checkpoint = self._checkpoints.get('initramfs')
+         if irf_checkpoint is not None and \
+            irf_checkpoint['sources'] == irf_sources and all(
+               os.path.isfile(archive_path)
+               for archive_path in irf_checkpoint['archive_paths']
+            ) \
+         :
+            self.einfo('Initramfs already generated')
+         else:
+            # Remove any archives, symlinks and working directories left by a
+            # failed run, which might have been for different variants.
+            for file_path in glob.glob(
+               os.path.join(boot_path, 'initramfs-*')
+            ):
+               os.unlink(file_path)
+            for irf_work_path in glob.glob(
+               os.path.join(self._ebuild_pkg_root, 'initramfs-build*')
+            ):
+               shutil.rmtree(irf_work_path)
+            archive_paths = self.build_initramfs(irf_debug, irf_profile_path)
+            for variant, archive_path in zip(
+               self._irf_variants, archive_paths
+            ):
+               # Create a symlink for compatibility with GRUB’s
+               # /etc/grub.d/10_linux detection script.
+               os.symlink(
+                  os.path.basename(archive_path),
+                  os.path.dirname(archive_path) + '/initramfs-{}{}.img'.format(
+                     self._kernel_release, '-' + variant if variant else ''
+                  )
+               )
+            self._checkpoints.mark(
+               'initramfs', sources=irf_sources, archive_paths=archive_paths
+            )
+
+      # Complete the package creation, which will grab everything that’s in
+      # ${D}.
+      self.einfo('Creating package')
+      self.logged_check_call(('ebuild', self._ebuild_file_path, 'package'))
+      # Nothing left to resume.
+      self._checkpoints.delete()
+
+   def prepare_build_dir(self):
+      """Creates the separate build directory selected with set_build_path(),
+      mounting a tmpfs on it if requested, and copies the kernel configuration
+      into it.
+      """
+
+      makedirs(self._build_path)
+      tmpfs_marker_path = os.path.join(
+         self._build_path, self._tmpfs_marker_file_name
       )
-      shutil.copy2(self._src_image_path, os.path.join(
-         self._ebuild_pkg_root, 'boot/linux-' + self._kernel_release
+      if self._build_tmpfs_size and os.path.ismount(self._build_path):
+         # Take over a tmpfs left mounted by a failed run, so that it’s
+         # unmounted once done; leave any other mount alone.
+         self._build_tmpfs_mounted = os.path.exists(tmpfs_marker_path)
+      elif self._build_tmpfs_size:
+         # Don’t let the tmpfs take away the memory the compiler will need.
+         mem_available = meminfo().get('MemAvailable', 0)
+         if self._build_tmpfs_size + self._tmpfs_reserved_memory > \
+            mem_available \
+         :
+            self.eerror(
+               'Not enough memory for a {} MiB tmpfs build directory: only {} '
+               .format(
+                  self._build_tmpfs_size // (1024 * 1024),
+                  mem_available // (1024 * 1024)
+               ) + 'MiB available, and {} MiB must be left free.'.format(
+                  self._tmpfs_reserved_memory // (1024 * 1024)
+               )
+            )
+            raise GeneratorError()
+         self.einfo('Mounting tmpfs on build directory \033[1;37m{}\033[0m'
+            .format(self._build_path)
+         )
+         self.logged_check_call((
+            'mount', '-t', 'tmpfs',
+            '-o', 'size={},mode=0755'.format(self._build_tmpfs_size),
+            'kernel-gen', self._build_path
+         ))
+         self._build_tmpfs_mounted = True
+         open(tmpfs_marker_path, 'w').close()
+      build_config_path = os.path.join(self._build_path, '.config')
+      if self._build_config_path:
+         # Preserve the modification time, so that the kernel is only rebuilt
+         # if the configuration changed.
+         shutil.copy2(self._build_config_path, build_config_path)
+      if not os.path.isfile(build_config_path):
+         self.eerror(
+            'The build directory `{}\' contains no kernel configuration; '
+            .format(self._build_path) + 'please specify one using --config.'
+         )
+         raise GeneratorError()
+
+   def rebuild_module_indexes(self, irf_work_path):
+      """Brings the kernel module indexes in an initramfs working directory up
+      to date with the modules it actually contains, which may differ from
+      those installed by modules_install due to pruning or to the initramfs
+      build script.
+
+      str irf_work_path
+         Directory in which the initramfs is being built.
+      """
+
+      rebuild = False
+      for lib_dir in os.listdir(irf_work_path):
+         modules_path = os.path.join(
+            irf_work_path, lib_dir, 'modules', self._kernel_release
+         )
+         if not lib_dir.startswith('lib') or not os.path.isdir(modules_path):
+            continue
+         rebuild = True
+         # These point to the kernel source and build directories, which are
+         # not part of the initramfs.
+         for link_name in ('build', 'source'):
+            link_path = os.path.join(modules_path, link_name)
+            if os.path.islink(link_path):
+               os.unlink(link_path)
+         # Remove directories left empty by pruning.
+         for base_path, dir_names, file_names in os.walk(
+            modules_path, topdown=False
+         ):
+            if base_path != modules_path and not os.listdir(base_path):
+               os.rmdir(base_path)
+         # Drop missing modules from modules.order, which depmod uses to
+         # order modules.dep.
+         order_path = os.path.join(modules_path, 'modules.order')
+         if os.path.isfile(order_path):
+            with open(order_path, 'r') as order_file:
+               module_paths = order_file.read().splitlines()
+            # Replace the file rather than rewriting it, since it may be
+            # hardlinked to files outside the initramfs.
+            with open(order_path + '.tmp', 'w') as order_file:
+               for module_path in module_paths:
+                  module_path_prefix = os.path.join(modules_path, module_path)
+                  if any(
+                     os.path.exists(module_path_prefix + ext)
+                     for ext in self._module_file_exts
+                  ):
+                     order_file.write(module_path + '\n')
+            os.rename(order_path + '.tmp', order_path)
+      if not rebuild:
+         return
+
+      # Regenerate modules.dep, modules.alias, etc. and their binary versions.
+      args = [
+         self._kmake_env.get('DEPMOD', 'depmod'), '--basedir', irf_work_path
+      ]
+      system_map_path = os.path.join(self._kbuild_output_path, 'System.map')
+      if os.path.isfile(system_map_path):
+         # Also check that every module’s symbols can be resolved.
+         args.extend(('--errsyms', '--filesyms', system_map_path))
+      args.append(self._kernel_release)
+      self.logged_check_call(args)
+
+   def rebuild_module_packages(self, packages):
+      """Makes sure that the dependencies of the specified packages are
+      installed, then rebuilds the packages against the kernel being built,
+      only generating their binary packages.
+
+      Dependencies are resolved only once, through Portage’s API, unless
+      that’s not available or a cross-compiling emerge wrapper is needed; in
+      that case, emerge is invoked twice.
+
+      iterable(str*) packages
+         Packages providing out-of-tree modules.
+      """
+
+      packages = list(packages)
+      emerge_env = {'KERNEL_DIR': self._source_path}
+      if self._build_path:
+         emerge_env['KBUILD_OUTPUT'] = self._build_path
+
+      def plan(tasks, favorites):
+         # Split the graph into the dependencies to merge and the packages to
+         # only build.
+         target_cps = set(
+            portage_dep.Atom(package).cp for package in packages
+         )
+         dep_tasks = []
+         build_tasks = []
+         for task in tasks:
+            if getattr(task, 'operation', None) == 'merge' and \
+               task.cp in target_cps \
+            :
+               build_tasks.append(task)
+            else:
+               dep_tasks.append(task)
+         # Only the packages being built need to find the kernel.
+         return (
+            (dep_tasks, {}, favorites, None, 'Merging {} dependencies'),
+            (
+               build_tasks, {'--buildpkgonly': True}, favorites, emerge_env,
+               'Building {} packages'
+            ),
+         )
+
+      if not self._cross_compiler_prefix and self.resolve_and_merge(
+         [
+            '--update', '--changed-use',
+            '--reinstall-atoms', ' '.join(packages),
+            '--usepkg-exclude', ' '.join(packages),
+         ] + packages, plan
+      ):
+         return
+
+      # First make sure that all the modules’ dependencies are installed.
+      self.emerge_check_call(None,
+         '--changed-use', '--onlydeps', '--update', *packages
+      )
+      # Then (re)build the modules, but only generate their binary packages.
+      env = dict(os.environ)
+      env.update(emerge_env)
+      self.emerge_check_call(env,
+         '--buildpkgonly', '--usepkg=n', *packages
+      )
+
+   def report_compile_profile(self, compile_profiler, top = 5):
+      """Writes the compile time profile of the kernel build to the file
+      selected with set_compile_profile(), and displays its highlights.
+
+      CompileProfiler compile_profiler
+         Profiler that recorded the build.
+      int top
+         Number of most expensive directories and configuration options to
+         display.
+      """
+
+      self.einfo('Writing compile time profile to {}'.format(
+         self._compile_profile_path
       ))
-      # Create a symlink for compatibility with GRUB’s /etc/grub.d/10_linux
-      # detection script.
-      os.symlink('linux-' + self._kernel_release, os.path.join(
-         self._ebuild_pkg_root, 'boot/kernel-' + self._kernel_release
+      compile_profiler.write_json(self._compile_profile_path)
+      profile = compile_profiler.profile(top)
+      self._events.emit('compile_profile', **profile)
+      self.eindent()
+      self.einfo('{} objects compiled in {:.1f} s of CPU time'.format(
+         profile['total']['objects'], profile['total']['cpu_time']
       ))
+      for entries_key, key, title in (
+         ('directories', 'path', 'Most expensive directories:'),
+         ('configs', 'config', 'Most expensive configuration options:'),
+      ):
+         if not profile[entries_key]:
+            continue
+         self.einfo(title)
+         self.eindent()
+         for totals in profile[entries_key]:
+            self.einfo('{}: {:.1f} s, {} objects, {} KiB'.format(
+               totals[key], totals['cpu_time'], totals['objects'],
+               totals['size'] // 1024
+            ))
+         self.eoutdent()
+      self.eoutdent()
 
-      self.einfo('Adding modules')
-      self.kmake_check_call(
-         'INSTALL_MOD_PATH=' + self._ebuild_pkg_root, 'modules_install'
-      )
+   def resolve_and_merge(self, args, plan):
+      """Resolves in a single pass the dependency graph for an emerge command
+      line through Portage’s API, then executes one or more merges of parts
+      of the resulting plan, without starting emerge again.
 
-      if self._irf_source_path:
-         self._irf_archive_path = os.path.join(
-            self._ebuild_pkg_root, 'boot/initramfs-{}.cpio{}'.format(
-               self._kernel_release, self._irf_compressor.file_name_ext()
-            )
+      iterable(str*) args
+         emerge options and atoms, in addition to EMERGE_DEFAULT_OPTS.
+      callable(list(object), list(object)) plan
+         Function that will be called with the ordered tasks and the
+         favorites of the resolved graph, and must return an iterable of
+         (tasks, extra_opts, favorites, env, description) tuples, one for
+         each merge to execute; env is a dictionary of additional environment
+         variables for that merge only, or None, and description is
+         formatted with the number of tasks.
+      bool return
+         True if done, or False if Portage’s API is not available or not
+         compatible; in that case nothing has been merged.
+      """
+
+      try:
+         from _emerge.actions import load_emerge_config
+         from _emerge.create_depgraph_params import create_depgraph_params
+         from _emerge.depgraph import backtrack_depgraph
+         from _emerge.main import parse_opts
+         from _emerge.Scheduler import Scheduler
+         from _emerge.stdout_spinner import stdout_spinner
+      except ImportError:
+         return False
+
+      all_args = shlex.split(
+         self._portage_config.get('EMERGE_DEFAULT_OPTS', '')
+      )
+      all_args.extend(('--quiet', '--quiet-build=y', '--quiet-fail=y'))
+      all_args.extend(args)
+      merged = False
+      try:
+         action, opts, atoms = parse_opts(all_args, silent=True)
+         emerge_config = load_emerge_config(
+            env=self.emerge_env(), action=action, args=atoms, opts=opts
          )
-         self.build_initramfs(irf_debug)
-         # Create a symlink for compatibility with GRUB’s /etc/grub.d/10_linux
-         # detection script.
-         os.symlink(
-            os.path.basename(self._irf_archive_path),
-            os.path.dirname(self._irf_archive_path) +
-               '/initramfs-{}.img'.format(self._kernel_release)
+         settings = emerge_config.target_config.settings
+         trees = emerge_config.trees
+         mtimedb = emerge_config.target_config.mtimedb
+         spinner = stdout_spinner()
+         spinner.update = spinner.update_quiet
+
+         self.einfo('Resolving dependencies')
+         with self._output_log.capture():
+            success, depgraph, favorites = backtrack_depgraph(
+               settings, trees, opts, create_depgraph_params(opts, action),
+               action, atoms, spinner
+            )
+            if not success:
+               depgraph.display_problems()
+         if not success:
+            self.eerror(
+               'Unable to resolve dependencies; details in `{}\''.format(
+                  self._output_log.file_path()
+               )
+            )
+            raise GeneratorError()
+
+         for tasks, extra_opts, merge_favorites, merge_env, description in \
+            plan(depgraph.altlist(), favorites) \
+         :
+            if not tasks:
+               continue
+            self.einfo(description.format(len(tasks)))
+            merge_opts = dict(opts)
+            merge_opts.update(extra_opts)
+            # The Scheduler configures each ebuild from the trees’ settings.
+            with self._output_log.capture(), portage_config_env(
+               (tree['vartree'].settings for tree in trees.values()),
+               merge_env
+            ):
+               scheduler = Scheduler(
+                  settings, trees, mtimedb, merge_opts, spinner, tasks,
+                  merge_favorites, None
+               )
+               merged = True
+               ret = scheduler.merge()
+            if ret != os.EX_OK:
+               self.eerror('emerge failed; details in `{}\''.format(
+                  self._output_log.file_path()
+               ))
+               raise GeneratorError()
+      except (AttributeError, TypeError) as x:
+         # Portage’s private API changed; that’s only safe to work around if
+         # nothing was merged yet.
+         if merged:
+            raise
+         self.ewarn('Unable to use Portage’s API ({}); running emerge'.format(
+            x
+         ))
+         return False
+      return True
+
+   def restore_kernel_artifacts(self, cache_entry_path):
+      """Places the kernel image, symbol table and in-tree modules from an
+      artifact cache entry into the build directory, as if they had just been
+      built.
+
+      str cache_entry_path
+         Path to the artifact cache entry.
+      """
+
+      # Prepare the build directory for building out-of-tree modules.
+      self.kmake_check_call('modules_prepare')
+      # Never hardlink files that a later build might overwrite in place.
+      materializer = FileMaterializer(hardlink=False)
+      makedirs(os.path.dirname(self._src_image_path))
+      materializer.copy_file(
+         os.path.join(cache_entry_path, 'image'), self._src_image_path
+      )
+      for file_name in ('System.map', 'Module.symvers'):
+         src_file_path = os.path.join(cache_entry_path, file_name)
+         if os.path.exists(src_file_path):
+            materializer.copy_file(src_file_path, os.path.join(
+               self._kbuild_output_path, file_name
+            ))
+      # Copy the modules now, so that the entry can be evicted at any time.
+      if os.path.isdir(self._cached_modules_path):
+         shutil.rmtree(self._cached_modules_path)
+      files, size = self._materializer.copy_tree(
+         os.path.join(cache_entry_path, 'modules'), self._cached_modules_path
+      )
+      self._events.emit(
+         'copy', step='artifact cache', variant=None, files=files, bytes=size
+      )
+
+   def run_cpio(self, out_file, irf_work_path):
+      """Creates an uncompressed cpio archive of a directory.
+
+      file out_file
+         File or pipe the archive will be written to.
+      str irf_work_path
+         Directory to archive.
+      """
+
+      cpio_args = (
+         'cpio', '--create', '--format=newc', '--null', '--owner=0:0'
+      )
+      find_args = ('find', '.', '-print0')
+      with self._events.process(cpio_args) as cpio_status:
+         # Make cpio write to out_file, and redirect its stderr to /dev/null
+         # since it likes to output junk.
+         cpio_proc = subprocess.Popen(
+            cpio_args,
+            stdin=subprocess.PIPE, stdout=out_file, stderr=self._dev_null,
+            cwd=irf_work_path
          )
+         with self._events.process(find_args) as find_status:
+            # Use find . to enumerate the files for cpio to pack.
+            find_proc = subprocess.Popen(
+               find_args, stdout=cpio_proc.stdin, cwd=irf_work_path
+            )
+            find_proc.communicate()
+            find_status['returncode'] = find_proc.returncode
+         cpio_proc.communicate()
+         cpio_status['returncode'] = cpio_proc.returncode
 
-      # Complete the package creation, which will grab everything that’s in
-      # ${D}.
-      self.einfo('Creating package')
-      subprocess.check_call(
-         ('ebuild', self._ebuild_file_path, 'package'),
-         stdout=self._dev_null, stderr=subprocess.STDOUT
+   def select_initramfs_compressor(self, cpio_path):
+      """Benchmarks every initramfs compressor enabled in the kernel
+      configuration on (a sample of) the uncompressed initramfs archive, and
+      picks one according to the policy set with set_initramfs_compression().
+
+      str cpio_path
+         Path to the uncompressed cpio archive.
+      Compressor return
+         Selected compressor.
+      """
+
+      self.einfo('Benchmarking initramfs compressors')
+      self.eindent()
+      bench_path = tempfile.mkdtemp(dir=os.path.dirname(cpio_path))
+      try:
+         cpio_size = os.path.getsize(cpio_path)
+         if cpio_size > self._irf_compression_sample_size:
+            # Only benchmark on the start of the archive.
+            sample_path = os.path.join(bench_path, 'sample')
+            with open(cpio_path, 'rb') as cpio_file:
+               with open(sample_path, 'wb') as sample_file:
+                  sample_file.write(
+                     cpio_file.read(self._irf_compression_sample_size)
+                  )
+            sample_size = self._irf_compression_sample_size
+         else:
+            sample_path = cpio_path
+            sample_size = cpio_size
+         # Scale sample measurements up to the whole archive.
+         scale = float(cpio_size) / max(sample_size, 1)
+         compressed_path = os.path.join(bench_path, 'compressed')
+
+         best_compr = None
+         best_cost = None
+         for compr in self._irf_enabled_compressors:
+            try:
+               with open(sample_path, 'rb') as sample_file:
+                  with open(compressed_path, 'wb') as compressed_file:
+                     with self._events.process(compr.cmd_args()):
+                        subprocess.check_call(
+                           compr.cmd_args(),
+                           stdin=sample_file, stdout=compressed_file,
+                           stderr=self._dev_null
+                        )
+               with open(compressed_path, 'rb') as compressed_file:
+                  with self._events.process(compr.decompress_cmd_args()):
+                     # Only time the decompressor, not event subscribers.
+                     start_time = time.time()
+                     subprocess.check_call(
+                        compr.decompress_cmd_args(),
+                        stdin=compressed_file, stdout=self._dev_null,
+                        stderr=self._dev_null
+                     )
+                     decompress_time = (time.time() - start_time) * scale
+            except (OSError, subprocess.CalledProcessError):
+               # The compressor is not installed, or doesn’t work.
+               self.ewarn('{}: unavailable'.format(compr.cmd_args()[0]))
+               continue
+            compressed_size = os.path.getsize(compressed_path) * scale
+            if self._irf_compression_policy == 'smallest':
+               cost = compressed_size
+            else:
+               # Estimate the time needed to load and decompress the archive.
+               cost = compressed_size / self._irf_compression_read_speed + \
+                  decompress_time
+            ratio = compressed_size * 100 / max(cpio_size, 1)
+            self.einfo('{}: {:.1f}% of {} bytes, decompressed in {:.3f} s'
+               .format(compr.cmd_args()[0], ratio, cpio_size, decompress_time)
+            )
+            if best_cost is None or cost < best_cost:
+               best_compr = compr
+               best_cost = cost
+      finally:
+         shutil.rmtree(bench_path)
+         self.eoutdent()
+      if not best_compr:
+         self.eerror('No usable initramfs compressor found')
+         raise GeneratorError()
+      self.einfo('Selected {} for the initramfs'.format(
+         best_compr.cmd_args()[0]
+      ))
+      return best_compr
+
+   def set_artifact_cache(self, cache_path, max_size = '20G'):
+      """Enables an artifact cache, from which the kernel image and in-tree
+      modules will be restored instead of being built, if the same sources
+      and configuration were built before with the same toolchain; otherwise,
+      they will be added to it once built. Must be called before
+      set_sources().
+
+      str cache_path
+         Path to the cache directory, possibly shared among multiple hosts.
+      str max_size
+         Maximum total size of the cache (e.g. “20G”); the least recently
+         used entries will be evicted to stay within it.
+      """
+
+      max_bytes = parse_size(max_size)
+      if not max_bytes:
+         self.eerror('Invalid artifact cache size: {}'.format(max_size))
+         raise GeneratorError()
+      self._artifact_cache = ArtifactCache(
+         os.path.abspath(cache_path), max_bytes
       )
 
-   def set_sources(self, source_path = None, irf_source_path = None):
+   def set_build_path(self, build_path, config_path = None, tmpfs_size = None):
+      """Selects a build directory separate from the kernel source directory
+      (as with make O=…), so that the source directory is never written to.
+      Must be called before set_sources().
+
+      str build_path
+         Path to the build directory; it will be created if missing.
+      str config_path
+         Path to a kernel configuration file to copy into the build
+         directory; if None, the build directory must already contain one.
+      str tmpfs_size
+         If not None, mount a tmpfs of this size (e.g. “6G”) on the build
+         directory, unless one is already mounted; it will be unmounted when
+         this object is destroyed.
+      """
+
+      self._build_path = os.path.abspath(build_path)
+      self._build_config_path = config_path and os.path.abspath(config_path)
+      if tmpfs_size:
+         self._build_tmpfs_size = parse_size(tmpfs_size)
+         if not self._build_tmpfs_size:
+            self.eerror('Invalid tmpfs size: {}'.format(tmpfs_size))
+            raise GeneratorError()
+
+   def set_compile_profile(self, profile_path):
+      """Enables profiling of the kernel build, recording the time spent
+      compiling each object file.
+
+      str profile_path
+         Path to the JSON file that will receive the profile, listing the
+         most expensive objects, directories and configuration options; if
+         None, profiling is disabled.
+      """
+
+      self._compile_profile_path = profile_path
+
+   def set_initramfs_compression(self, policy, read_speed = 100):
+      """Selects how the initramfs compressor is picked. Must be called before
+      set_sources().
+
+      str policy
+         “config” (default) to pick the same compressor as the kernel image
+         if possible, or else the first one enabled in the kernel
+         configuration; otherwise, every compressor enabled in the kernel
+         configuration is benchmarked on the actual archive, and the one
+         yielding the “smallest” archive or the “fastest” boot is picked.
+      int read_speed
+         Speed, in MiB/s, at which the boot loader or kernel is expected to
+         read the initramfs; used by the “fastest” policy to weigh archive
+         size against decompression time.
+      """
+
+      if policy == 'config':
+         self._irf_compression_policy = None
+      elif policy in self._irf_compression_policies:
+         self._irf_compression_policy = policy
+      else:
+         self.eerror('Unknown initramfs compression policy: {}'.format(policy))
+         raise GeneratorError()
+      self._irf_compression_read_speed = float(read_speed) * 1024 * 1024
+
+   def set_make_jobs(
+      self, jobs = 'auto', load_average = None, job_memory = None
+   ):
+      """Selects how many jobs make will run in parallel, for both the kernel
+      and out-of-tree modules. Must be called before set_sources().
+
+      str jobs
+         “auto” (default) to size the number of jobs on idle online CPUs,
+         distcc hosts (if enabled) and available memory; “makeopts” to keep
+         using the -j/-l options from Portage’s ${MAKEOPTS}; or a number of
+         jobs.
+      float load_average
+         Load average limit for make (-l); defaults to the number of online
+         CPUs.
+      str job_memory
+         Memory needed by each make job (e.g. “768M”) when sizing the number
+         of jobs automatically; defaults to 512 MiB.
+      """
+
+      if jobs in ('auto', 'makeopts'):
+         self._make_jobs = jobs
+      else:
+         try:
+            self._make_jobs = int(jobs)
+         except ValueError:
+            self._make_jobs = 0
+         if self._make_jobs <= 0:
+            self.eerror('Invalid number of make jobs: {}'.format(jobs))
+            raise GeneratorError()
+      self._make_load_average = load_average
+      if job_memory:
+         # Override the class default.
+         self._make_job_memory = parse_size(job_memory)
+         if not self._make_job_memory:
+            self.eerror('Invalid memory size: {}'.format(job_memory))
+            raise GeneratorError()
+
+   def set_resume(self, resume = True):
+      """Selects whether to resume a previous run that failed, skipping the
+      phases it completed (creating the temporary ebuild, rebuilding
+      out-of-tree modules, building the kernel, adding the kernel and modules
+      to the package, and generating the initramfs), as long as their results
+      are still valid. Must be called before set_sources().
+
+      bool resume
+         If True, resume the previous run, if any.
+      """
+
+      self._resume = resume
+
+   @event_phase('sources')
+   def set_sources(
+      self, source_path = None, irf_source_path = None, irf_variants = None
+   ):
       """Assigns a kernel source path, loading and validating the
       configuration found therein.
 
@@ -818,11 +2366,13 @@ class Generator(object):
       str irf_source_path
          Path to an initramfs source directory, or None to default to
          /usr/src/initramfs.
+      collections.OrderedDict(str: str) irf_variants
+         Additional initramfs source directories, by variant name; an
+         initramfs will be built from each of them.
       """
 
       self.einfo('Gathering kernel information')
       self._source_path = source_path
-      self._irf_source_path = irf_source_path
 
       # Ensure we have a valid kernel source directory, and get its version.
       if self._source_path:
@@ -872,7 +2422,21 @@ class Generator(object):
       self._kernel_version = kernel_version
 
       self._source_path = os.path.abspath(self._source_path)
-      self._src_config_path = os.path.join(self._source_path, '.config')
+      if self._build_path:
+         self.prepare_build_dir()
+         self._kmake_args.append('O=' + self._build_path)
+         self._kbuild_output_path = self._build_path
+      else:
+         self._kbuild_output_path = self._source_path
+      self._src_config_path = os.path.join(self._kbuild_output_path, '.config')
+      # Keep restored modules out of the build directory, which might be the
+      # source directory; name them after it, since they belong to the kernel
+      # restored into it.
+      self._cached_modules_path = os.path.join(
+         self._state_path, 'cached-modules-' + hashlib.sha256(
+            self._kbuild_output_path.encode('utf-8')
+         ).hexdigest()[:16]
+      )
 
       # Verify that the kernel has been configured, and get its release string
       # (= version + local).
@@ -887,22 +2451,22 @@ class Generator(object):
 
       # Determine the location of the generated kernel image.
       image_path = self.kmake_check_output('image_name')
-      self._src_image_path = os.path.join(self._source_path, image_path)
+      self._src_image_path = os.path.join(self._kbuild_output_path, image_path)
       del image_path
 
-      if self._irf_source_path:
-         if self._irf_source_path is True:
+      if irf_source_path:
+         if irf_source_path is True:
             if 'CONFIG_BLK_DEV_INITRD' not in kernel_config:
                self.ewarn(
                   'The selected kernel was not configured to support an ' +
                   'initramfs/initrd.'
                )
-               self._irf_source_path = False
+               irf_source_path = False
             else:
-               self._irf_source_path = os.path.join(
+               irf_source_path = os.path.join(
                   self._root, 'usr/src/initramfs'
                )
-               if not os.path.isdir(self._irf_source_path):
+               if not os.path.isdir(irf_source_path):
                   self.ewarn(
                      'The selected kernel was configured to support ' +
                      'initramfs/initrd, but no suitable'
@@ -911,43 +2475,163 @@ class Generator(object):
                      'initramfs source directory was specified or found.'
                   )
                   self.ewarn('No initramfs will be created.')
-                  self._irf_source_path = False
+                  irf_source_path = False
          else:
-            if 'CONFIG_BLK_DEV_INITRD' not in kernel_config:
-               self.eerror(
-                  'The selected kernel was not configured to support an ' +
-                  'initramfs/initrd.'
-               )
-               raise GeneratorError()
-            if not os.path.isdir(self._irf_source_path):
-               self.eerror(
-                  'The initramfs path `{}\' is not a directory.'.format(
-                     self._irf_source_path
-                  )
-               )
-               raise GeneratorError()
-
-      if self._irf_source_path:
+            self.validate_initramfs_source(irf_source_path, kernel_config)
+      self._irf_variants = collections.OrderedDict()
+      if irf_source_path:
+         self._irf_variants[None] = irf_source_path
+      for variant, variant_source_path in (irf_variants or {}).items():
+         self.validate_initramfs_source(variant_source_path, kernel_config)
+         self._irf_variants[variant] = variant_source_path
+
+      if self._irf_variants:
          # TODO: check that these CONFIG_ match:
          #   +DEVTMPFS
 
          # Check for an enabled initramfs compression method.
-         enabled_irf_compressors = []
-         for compr in self._compressors:
-            if compr.enabled_in_config(kernel_config, 'CONFIG_RD_'):
-               if compr is kernel_compressor:
-                  # We can pick the same compression for kernel image and
-                  # initramfs.
-                  self._irf_compressor = kernel_compressor
-                  break
-               # Not the same as the kernel image, but make a note of this in
-               # case the condition above is never satisfied.
-               enabled_irf_compressors.append(compr)
+         self._irf_enabled_compressors = [
+            compr for compr in self._compressors
+            if compr.enabled_in_config(kernel_config, 'CONFIG_RD_')
+         ]
+         if kernel_compressor in self._irf_enabled_compressors:
+            # We can pick the same compression for kernel image and
+            # initramfs.
+            self._irf_compressor = kernel_compressor
          else:
             # Pick the first enabled compression method.
-            self._irf_compressor = enabled_irf_compressors[0]
+            self._irf_compressor = self._irf_enabled_compressors[0]
 
       # Determine if cross-compiling.
       self._cross_compiler_prefix = kernel_config.get('CONFIG_CROSS_COMPILE')
 
       self.make_package_name(kernel_config)
+
+      # Checkpoints are only valid for the same sources and configuration.
+      self._checkpoints = PhaseCheckpoints(
+         os.path.join(self._state_path, '{}-{}.checkpoint'.format(
+            self._package_name, self._package_version
+         )), {
+            'config_mtime': os.path.getmtime(self._src_config_path),
+            'config_size': os.path.getsize(self._src_config_path),
+            'kbuild_output_path': self._kbuild_output_path,
+            'kernel_release': self._kernel_release,
+            'source_path': self._source_path,
+         }
+      )
+      if self._resume:
+         if self._checkpoints.load():
+            self.einfo('Resuming the previous run')
+         else:
+            self.ewarn('No previous run to resume; starting over')
+
+      # Size the make job budget now that any tmpfs build directory is
+      # mounted, so that the memory it will take up can be accounted for.
+      self._make_jobs_args = self.compute_make_jobs()
+      self._kmake_args.extend(self._make_jobs_args)
+
+   def store_kernel_artifacts(self, cache_entry_path):
+      """Copies the kernel image, symbol table and in-tree modules just built
+      into a new artifact cache entry.
+
+      str cache_entry_path
+         Path to the (empty) artifact cache entry.
+      """
+
+      # Never hardlink files that a later build might overwrite in place.
+      materializer = FileMaterializer(hardlink=False)
+      materializer.copy_file(
+         self._src_image_path, os.path.join(cache_entry_path, 'image')
+      )
+      for file_name in ('System.map', 'Module.symvers'):
+         src_file_path = os.path.join(self._kbuild_output_path, file_name)
+         if os.path.exists(src_file_path):
+            materializer.copy_file(
+               src_file_path, os.path.join(cache_entry_path, file_name)
+            )
+      self.kmake_check_call(
+         'INSTALL_MOD_PATH=' + os.path.join(cache_entry_path, 'modules'),
+         'modules_install'
+      )
+
+   def stale_module_packages(self, force = False):
+      """Enumerates the packages providing out-of-tree modules that need to
+      be rebuilt for the kernel just built, i.e. those that don’t have any
+      modules for its release, or have some with a different vermagic.
+
+      bool force
+         If True, all packages providing out-of-tree modules will be
+         returned.
+      str yield
+         Package, with its slot instead of its version.
+      """
+
+      oote = self.out_of_tree_enumerator()
+      if force:
+         for package in oote.packages(firmware=False):
+            yield package
+         return
+
+      kernel_vermagic = self.kernel_vermagic()
+      if kernel_vermagic is None:
+         self.ewarn(
+            'Unable to determine the kernel’s vermagic; rebuilding all ' +
+            'out-of-tree modules'
+         )
+      module_path_prefix = 'lib/modules/{}/'.format(self._kernel_release)
+      up_to_date = 0
+      for package, files in oote.packages_and_files(
+         firmware=False, strip_prefixes=False
+      ):
+         module_paths = [
+            file_path for file_path in files
+            if file_path.startswith(module_path_prefix)
+         ]
+         stale = kernel_vermagic is None or not module_paths
+         for module_path in module_paths:
+            if stale:
+               break
+            try:
+               module_vermagic = ModuleInfo(os.path.join(
+                  self._portage_config['EROOT'], module_path
+               )).get('vermagic')
+            except (IOError, OSError, ValueError, struct.error,
+               subprocess.CalledProcessError
+            ):
+               # Missing or unreadable module; rebuild it to be safe.
+               module_vermagic = None
+            stale = module_vermagic is None or \
+               module_vermagic.split() != kernel_vermagic.split()
+         if stale:
+            yield package
+         else:
+            up_to_date += 1
+      if up_to_date:
+         self.einfo(
+            'Skipping {} out-of-tree modules\' packages already built for '
+            .format(up_to_date) + 'this kernel'
+         )
+
+   def validate_initramfs_source(self, irf_source_path, kernel_config):
+      """Ensures that an explicitly-specified initramfs source directory can
+      be used with the selected kernel.
+
+      str irf_source_path
+         Path to the initramfs source directory.
+      dict(str: str) kernel_config
+         Kernel configuration.
+      """
+
+      if 'CONFIG_BLK_DEV_INITRD' not in kernel_config:
+         self.eerror(
+            'The selected kernel was not configured to support an ' +
+            'initramfs/initrd.'
+         )
+         raise GeneratorError()
+      if not os.path.isdir(irf_source_path):
+         self.eerror(
+            'The initramfs path `{}\' is not a directory.'.format(
+               irf_source_path
+            )
+         )
+         raise GeneratorError()
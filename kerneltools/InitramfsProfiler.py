@@ -0,0 +1,225 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class InitramfsProfiler."""
+
+import json
+import os
+import stat
+import zlib
+
+##############################################################################
+# InitramfsProfiler
+
+class InitramfsProfiler(object):
+   """Records which step of the initramfs build added each file, and reports
+   the size of files and directories, both raw and as estimated after
+   compression.
+   """
+
+   # Size of the chunks in which files are read to estimate their compressed
+   # size.
+   _chunk_size = 1024 * 1024
+   # zlib compression level used to estimate compressed sizes.
+   _zlib_level = 6
+
+   def __init__(self, work_path):
+      """Constructor.
+
+      str work_path
+         Directory in which the initramfs is being built.
+      """
+
+      # Maps each file path, relative to work_path, to a tuple containing
+      # the step that added it and the package it belongs to, if known.
+      self._origins = {}
+      self._steps = []
+      self._work_path = work_path
+
+   def add_step(self, step, packages = None):
+      """Attributes to a build step all files that appeared in the work
+      directory after the previous step, and forgets files that have been
+      removed.
+
+      str step
+         Name of the step.
+      dict(str: str) packages
+         Package that provided each file, by path relative to the work
+         directory; files not in it are attributed to the step alone.
+      """
+
+      packages = packages or {}
+      seen = set()
+      for rel_path in self._walk():
+         seen.add(rel_path)
+         if rel_path not in self._origins:
+            self._origins[rel_path] = (step, packages.get(rel_path))
+      for rel_path in list(self._origins):
+         if rel_path not in seen:
+            del self._origins[rel_path]
+      self._steps.append(step)
+
+   def copy(self, work_path):
+      """Returns a profiler that knows the origin of every file recorded so
+      far, for a copy of the work directory.
+
+      str work_path
+         Directory the copy of the initramfs is being built in.
+      kerneltools.InitramfsProfiler.InitramfsProfiler return
+         New profiler.
+      """
+
+      ret = InitramfsProfiler(work_path)
+      ret._origins = dict(self._origins)
+      ret._steps = list(self._steps)
+      return ret
+
+   def _estimate_compressed_size(self, file_path):
+      """Estimates the size of a file once compressed.
+
+      str file_path
+         Path to the file.
+      int return
+         Size of the file compressed with zlib.
+      """
+
+      compressor = zlib.compressobj(self._zlib_level)
+      ret = 0
+      with open(file_path, 'rb') as src_file:
+         while True:
+            chunk = src_file.read(self._chunk_size)
+            if not chunk:
+               break
+            ret += len(compressor.compress(chunk))
+      ret += len(compressor.flush())
+      return ret
+
+   def profile(self, top = 20):
+      """Measures every file in the work directory and aggregates the results.
+
+      int top
+         Number of largest files to list separately.
+      dict(str: object) return
+         Profile, suitable for JSON serialization.
+      """
+
+      def new_totals():
+         return {'files': 0, 'size': 0, 'compressed_size': 0}
+
+      def add_to_totals(totals, size, compressed_size):
+         totals['files'] += 1
+         totals['size'] += size
+         totals['compressed_size'] += compressed_size
+
+      total = new_totals()
+      by_dir = {}
+      by_package = {}
+      by_step = dict((step, new_totals()) for step in self._steps)
+      files = []
+      # Inodes of the regular files measured so far.
+      inodes = set()
+      for rel_path in sorted(self._origins):
+         step, package = self._origins[rel_path]
+         file_path = os.path.join(self._work_path, rel_path)
+         st = os.lstat(file_path)
+         if stat.S_ISREG(st.st_mode) and \
+            (st.st_dev, st.st_ino) not in inodes \
+         :
+            inodes.add((st.st_dev, st.st_ino))
+            size = st.st_size
+            compressed_size = self._estimate_compressed_size(file_path)
+         else:
+            # Symlinks, device nodes, further hardlinks to a file already
+            # measured, etc. only take up a cpio header.
+            size = 0
+            compressed_size = 0
+         files.append({
+            'path': rel_path,
+            'size': size,
+            'compressed_size': compressed_size,
+            'step': step,
+            'package': package,
+         })
+         add_to_totals(total, size, compressed_size)
+         add_to_totals(by_step[step], size, compressed_size)
+         if package:
+            add_to_totals(
+               by_package.setdefault(package, new_totals()),
+               size, compressed_size
+            )
+         # Add the file to each directory containing it.
+         dir_path = os.path.dirname(rel_path)
+         while dir_path:
+            add_to_totals(
+               by_dir.setdefault(dir_path, new_totals()),
+               size, compressed_size
+            )
+            dir_path = os.path.dirname(dir_path)
+
+      directories = []
+      for dir_path, totals in by_dir.items():
+         totals['path'] = dir_path
+         directories.append(totals)
+      directories.sort(key=lambda totals: totals['size'], reverse=True)
+      largest_files = sorted(
+         files, key=lambda file_info: file_info['size'], reverse=True
+      )[:top]
+      return {
+         'total': total,
+         'steps': by_step,
+         'packages': by_package,
+         'largest_files': largest_files,
+         'directories': directories,
+         'files': files,
+      }
+
+   def _walk(self):
+      """Enumerates all non-directory entries in the work directory.
+
+      str yield
+         Path to the entry, relative to the work directory.
+      """
+
+      work_path_len = len(self._work_path) + 1
+      for base_path, dir_names, file_names in os.walk(self._work_path):
+         base_path = base_path[work_path_len:]
+         if base_path:
+            base_path += '/'
+         for dir_name in dir_names:
+            # os.walk() doesn’t follow symlinks to directories, but lists them
+            # as directories.
+            rel_path = base_path + dir_name
+            if os.path.islink(os.path.join(self._work_path, rel_path)):
+               yield rel_path
+         for file_name in file_names:
+            yield base_path + file_name
+
+   def write_json(self, file_path, top = 20):
+      """Writes the profile returned by profile() to a JSON file.
+
+      str file_path
+         Path to the file to write.
+      int top
+         Number of largest files to list separately.
+      """
+
+      with open(file_path, 'w') as json_file:
+         json.dump(self.profile(top), json_file, indent=1, sort_keys=True)
+         json_file.write('\n')
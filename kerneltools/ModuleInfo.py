@@ -0,0 +1,135 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class ModuleInfo."""
+
+import gzip
+import struct
+import subprocess
+
+##############################################################################
+# ModuleInfo
+
+class ModuleInfo(object):
+   """Reads the information embedded by the kernel build system in the
+   .modinfo ELF section of a kernel module, such as its vermagic, without
+   relying on modinfo(8) or on the module being built for the running kernel.
+   """
+
+   # Programs to decompress modules, by file name extension.
+   _decompress_cmd_args = {
+      '.xz' : ('xz',   '-dc'),
+      '.zst': ('zstd', '-dc'),
+   }
+
+   def __init__(self, file_path):
+      """Constructor.
+
+      str file_path
+         Path to the module; it may be compressed with gzip, xz or zstd, as
+         indicated by its extension.
+      """
+
+      self._fields = None
+      self._file_path = file_path
+
+   def get(self, name):
+      """Returns the value of a field, reading the module if not done yet.
+
+      str name
+         Name of the field, e.g. “vermagic”.
+      str return
+         First value of the field, or None if the module doesn’t have it.
+      """
+
+      if self._fields is None:
+         self._fields = self._parse_modinfo(self._read())
+      return self._fields.get(name)
+
+   @staticmethod
+   def _parse_modinfo(elf):
+      """Extracts the .modinfo section from an ELF relocatable file and parses
+      its “name=value” entries.
+
+      bytes elf
+         Contents of the module.
+      dict(str: str) return
+         First value of each field.
+      """
+
+      if elf[:4] != b'\x7fELF':
+         raise ValueError('not an ELF file')
+      # EI_CLASS: 1 = 32-bit, 2 = 64-bit; EI_DATA: 1 = little, 2 = big endian.
+      elf_class = bytearray(elf[4:5])[0]
+      byte_order = '<' if bytearray(elf[5:6])[0] == 1 else '>'
+      if elf_class == 2:
+         shoff, = struct.unpack_from(byte_order + 'Q', elf, 0x28)
+         shentsize, shnum, shstrndx = struct.unpack_from(
+            byte_order + 'HHH', elf, 0x3a
+         )
+         # sh_name, sh_offset and sh_size.
+         section_fmt, offset_index, size_index = 'I20xQQ', 1, 2
+      else:
+         shoff, = struct.unpack_from(byte_order + 'I', elf, 0x20)
+         shentsize, shnum, shstrndx = struct.unpack_from(
+            byte_order + 'HHH', elf, 0x2e
+         )
+         section_fmt, offset_index, size_index = 'I12xII', 1, 2
+      section_fmt = byte_order + section_fmt
+      sections = [
+         struct.unpack_from(section_fmt, elf, shoff + i * shentsize)
+         for i in range(shnum)
+      ]
+      names_offset = sections[shstrndx][offset_index]
+
+      ret = {}
+      for section in sections:
+         name_offset = names_offset + section[0]
+         name = elf[name_offset:elf.index(b'\0', name_offset)]
+         if name != b'.modinfo':
+            continue
+         offset = section[offset_index]
+         modinfo = elf[offset:offset + section[size_index]]
+         for entry in modinfo.split(b'\0'):
+            name, sep, value = entry.partition(b'=')
+            if sep:
+               ret.setdefault(
+                  name.decode('utf-8', 'replace'),
+                  value.decode('utf-8', 'replace')
+               )
+         break
+      return ret
+
+   def _read(self):
+      """Reads the module, decompressing it if necessary.
+
+      bytes return
+         Contents of the module.
+      """
+
+      if self._file_path.endswith('.gz'):
+         with gzip.open(self._file_path, 'rb') as module_file:
+            return module_file.read()
+      for ext, cmd_args in self._decompress_cmd_args.items():
+         if self._file_path.endswith(ext):
+            with open(self._file_path, 'rb') as module_file:
+               return subprocess.check_output(cmd_args, stdin=module_file)
+      with open(self._file_path, 'rb') as module_file:
+         return module_file.read()
@@ -20,10 +20,26 @@
 
 """Implementation of the class OutOfTreeEnumerator."""
 
+import fnmatch
+import multiprocessing
 import os
 import portage
 import re
 
+
+def _scan_root(task):
+   """Process pool worker for OutOfTreeEnumerator.scan_roots().
+
+   tuple(str, bool, dict(str: object)) task
+      Root directory, use_slot argument and constructor arguments.
+   tuple(str, list(tuple(str, list(str)))) return
+      Root directory and the packages and matching files found in it.
+   """
+
+   root, use_slot, kwargs = task
+   oote = OutOfTreeEnumerator(root=root, **kwargs)
+   return root, list(oote.packages_and_files(use_slot))
+
 ##############################################################################
 # OutOfTreeEnumerator
 
@@ -32,24 +48,104 @@ class OutOfTreeEnumerator(object):
 
    _contents_line_re = re.compile(r'^obj\s+(?P<path>\S+)\s+')
    _firmware_path = 'lib/firmware/'
-   _module_path_prefix_re = re.compile(r'^lib/modules/[^/]+/')
+   # Extensions of kernel modules, optionally compressed.
+   _module_exts = ('.ko', '.ko.gz', '.ko.xz', '.ko.zst')
+   _module_path_prefix_re = re.compile(r'^lib/modules/(?P<release>[^/]+)/')
    _package_version_re = re.compile(r'-[0-9].*$')
 
-   def __init__(self, firmware, modules):
+   def __init__(
+      self, firmware, modules, categories = None, packages = None,
+      kernel_release = None, firmware_prefix = None, root = None,
+      strip_prefixes = True, eprefix = None
+   ):
       """Constructor.
 
       bool firmware
          Enumerate external firmware installed by non-kernel packages.
       bool modules
          Enumerate modules installed by non-kernel packages.
+      iterable(str*) categories
+         If not None, only enumerate packages in categories matching any of
+         these glob patterns.
+      iterable(str*) packages
+         If not None, only enumerate packages matching any of these glob
+         patterns; patterns containing a “/” are matched against
+         “category/name”, others against the package name alone. Versions
+         are never part of the match.
+      str kernel_release
+         If not None, only enumerate modules installed for this kernel
+         release, i.e. in lib/modules/<kernel_release>/.
+      str firmware_prefix
+         If not None, only enumerate firmware whose path relative to
+         lib/firmware/ starts with this prefix.
+      str root
+         Root directory whose VDB will be scanned, e.g. a chroot or container
+         root; defaults to Portage’s ${EROOT}. No Portage configuration is
+         loaded for it.
+      bool strip_prefixes
+         If True (default), module paths will be relative to
+         lib/modules/<kernel_release>/ and firmware paths to lib/firmware/;
+         if False, all paths will be relative to the root.
+      str eprefix
+         Portage’s ${EPREFIX}, which CONTENTS paths include; defaults to the
+         one in Portage’s configuration.
       """
 
-      root = portage.settings['EROOT']
+      if root is None:
+         root = portage.settings['EROOT']
+      if eprefix is None:
+         eprefix = portage.settings['EPREFIX']
+      self._categories = tuple(categories) if categories else None
       self._firmware = firmware
+      self._firmware_prefix = firmware_prefix or ''
+      self._kernel_release = kernel_release
       self._modules = modules
-      self._root_len = len(root)
+      if packages:
+         # Split patterns into those matching “category/name” and those only
+         # matching “name”.
+         self._package_names = tuple(
+            pattern for pattern in packages if '/' not in pattern
+         )
+         self._package_cpns = tuple(
+            pattern for pattern in packages if '/' in pattern
+         )
+      else:
+         self._package_names = None
+         self._package_cpns = None
+      # Paths in CONTENTS are relative to ${ROOT} but include ${EPREFIX}.
+      self._root_len = len(eprefix) + 1
+      self._scanned = None # Set by scan()
+      self._strip_prefixes = strip_prefixes
       self._vdb_path = os.path.join(root, portage.VDB_PATH)
 
+   def _category_matches(self, category):
+      """Checks whether a category can contain packages matching the criteria
+      specified in the constructor, so that categories that can’t are never
+      listed.
+
+      str category
+         Package category.
+      bool return
+         True if the category needs to be scanned, or False otherwise.
+      """
+
+      # Ignore the sys-kernel category: kernels may contain modules, but they
+      # would then be in-tree modules, not out-of-tree.
+      if category == 'sys-kernel':
+         return False
+      if self._categories is not None and not any(
+         fnmatch.fnmatchcase(category, pattern) for pattern in self._categories
+      ):
+         return False
+      if self._package_cpns is not None and not self._package_names:
+         # Only “category/name” patterns: the category must match at least
+         # one of them.
+         return any(
+            fnmatch.fnmatchcase(category, pattern.split('/', 1)[0])
+            for pattern in self._package_cpns
+         )
+      return True
+
    def files(self):
       """Enumerates all files matching the criteria specified in the
       constructor.
@@ -62,14 +158,18 @@ class OutOfTreeEnumerator(object):
          for file_path in files:
             yield file_path
 
-   def _get_package_kernel_modules(self, package_path):
-      """Parses a package’s CONTENTS file, collecting all kernel modules
-      provided by the package.
+   def _get_package_files(self, package_path):
+      """Parses a package’s CONTENTS file, collecting all kernel modules and
+      firmware files provided by the package.
 
       str package_path
          Path to the package’s directory in the VDB.
-      list(str) return
-         List of kernel modules in the package, if any.
+      list(tuple(str, str, str, str)) return
+         For each kernel module or firmware file in the package, a tuple
+         containing its kind (“module” or “firmware”), its path relative to
+         the root, its path relative to lib/modules/<release>/ or
+         lib/firmware/, and the kernel release it was installed for (None for
+         firmware, or modules outside of lib/modules/).
       """
 
       ret = []
@@ -82,17 +182,25 @@ class OutOfTreeEnumerator(object):
                continue
             # Remove the root.
             file_path = match.group('path')[self._root_len:]
-            if self._modules and file_path.endswith('.ko'):
+            if self._modules and file_path.endswith(self._module_exts):
                # Remove “lib/modules/linux-*/”.
-               file_path = self._module_path_prefix_re.sub('', file_path)
+               match = self._module_path_prefix_re.match(file_path)
+               if match:
+                  release = match.group('release')
+                  if self._kernel_release is not None and \
+                     release != self._kernel_release \
+                  :
+                     continue
+                  ret.append((
+                     'module', file_path, file_path[match.end():], release
+                  ))
+               elif self._kernel_release is None:
+                  ret.append(('module', file_path, file_path, None))
             elif self._firmware and file_path.startswith(self._firmware_path):
                # Remove “lib/firmware/”.
-               file_path = file_path[len(self._firmware_path):]
-            else:
-               # Not a file we’re interested in.
-               continue
-            # Add this file to the list.
-            ret.append(file_path)
+               rel_file_path = file_path[len(self._firmware_path):]
+               if rel_file_path.startswith(self._firmware_prefix):
+                  ret.append(('firmware', file_path, rel_file_path, None))
       return ret
 
    def _get_package_slot(self, package_path):
@@ -107,48 +215,176 @@ class OutOfTreeEnumerator(object):
       with open(os.path.join(package_path, 'SLOT'), 'r') as slot_file:
          return slot_file.read().strip()
 
-   def packages(self, use_slot = True):
+   def _package_matches(self, category, package):
+      """Checks whether a package matches the criteria specified in the
+      constructor, so that its CONTENTS file is only read if it does.
+
+      str category
+         Package category.
+      str package
+         Package name and version, as found in the VDB.
+      bool return
+         True if the package needs to be scanned, or False otherwise.
+      """
+
+      if self._package_names is None:
+         return True
+      name = self._package_version_re.sub('', package)
+      if any(
+         fnmatch.fnmatchcase(name, pattern) for pattern in self._package_names
+      ):
+         return True
+      cpn = category + '/' + name
+      return any(
+         fnmatch.fnmatchcase(cpn, pattern) for pattern in self._package_cpns
+      )
+
+   def packages(
+      self, use_slot = True, firmware = None, modules = None,
+      kernel_release = None
+   ):
       """Enumerates all packages that installed files matching the criteria
       specified in the constructor.
 
       bool use_slot
          If True (default), each package will end in its slot number instead
          of its version.
+      bool firmware
+      bool modules
+      str kernel_release
+         See packages_and_files().
       str yield
          Package.
       """
 
-      for package, files in self.packages_and_files(use_slot):
+      for package, files in self.packages_and_files(
+         use_slot, firmware, modules, kernel_release
+      ):
          yield package
 
-   def packages_and_files(self, use_slot = True):
+   def packages_and_files(
+      self, use_slot = True, firmware = None, modules = None,
+      kernel_release = None, strip_prefixes = None
+   ):
       """Enumerates all packages and/or files matching the criteria specified
-      in the constructor.
+      in the constructor. The other arguments can narrow down the results of
+      a single enumeration, which is mostly useful after scan().
 
       bool use_slot
          If True (default), each package will end in its slot number instead
          of its version.
+      bool firmware
+         If False, don’t enumerate firmware, even if requested in the
+         constructor.
+      bool modules
+         If False, don’t enumerate modules, even if requested in the
+         constructor.
+      str kernel_release
+         If not None, only enumerate modules installed for this kernel
+         release.
+      bool strip_prefixes
+         If not None, overrides the same constructor argument.
       tuple(str, list(str)) yield
          A tuple containing the package and the matching files it contains.
       """
 
+      kinds = set()
+      if firmware is not False:
+         kinds.add('firmware')
+      if modules is not False:
+         kinds.add('module')
+      if strip_prefixes is None:
+         strip_prefixes = self._strip_prefixes
+      if self._scanned is not None:
+         scanned = self._scanned
+      else:
+         scanned = self._scan_vdb()
+      for package, slot, entries in scanned:
+         files = [
+            rel_file_path if strip_prefixes else file_path
+            for kind, file_path, rel_file_path, release in entries
+            if kind in kinds and (
+               kernel_release is None or kind != 'module' or
+               release == kernel_release
+            )
+         ]
+         if files:
+            if use_slot:
+               # Replace the package version with its slot.
+               package = self._package_version_re.sub(':' + slot, package)
+            yield package, files
+
+   def scan(self):
+      """Scans the VDB, retaining the results so that any further enumeration
+      will not need to scan it again. This allows a single scan to serve
+      enumerations of modules and firmware, by passing the appropriate
+      arguments to packages_and_files().
+      """
+
+      self._scanned = list(self._scan_vdb())
+
+   @staticmethod
+   def scan_roots(roots, jobs = None, use_slot = True, **kwargs):
+      """Scans the VDBs of multiple roots concurrently, each in a separate
+      process.
+
+      iterable(str*) roots
+         Root directories to scan.
+      int jobs
+         Maximum number of concurrent processes; defaults to the number of
+         CPUs.
+      bool use_slot
+         If True (default), each package will end in its slot number instead
+         of its version.
+      dict(str: object) kwargs
+         Enumeration criteria, as accepted by the constructor.
+      list(tuple(str, list(tuple(str, list(str))))) return
+         For each root, in the order given, a tuple containing the root and
+         the packages and matching files found in it.
+      """
+
+      # Read ${EPREFIX} once here, so that workers don’t each have to load
+      # Portage’s configuration.
+      kwargs = dict(kwargs)
+      if kwargs.get('eprefix') is None:
+         kwargs['eprefix'] = portage.settings['EPREFIX']
+      tasks = [(root, use_slot, kwargs) for root in roots]
+      jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+      if jobs <= 1:
+         return [_scan_root(task) for task in tasks]
+      pool = multiprocessing.Pool(processes=jobs)
+      try:
+         return pool.map(_scan_root, tasks)
+      finally:
+         pool.close()
+         pool.join()
+
+   def _scan_vdb(self):
+      """Walks the VDB, parsing the CONTENTS of the packages matching the
+      criteria specified in the constructor.
+
+      tuple(str, str, list(tuple(str, str, str, str))) yield
+         A tuple containing the package (with its version), its slot, and its
+         matching files, as returned by _get_package_files().
+      """
+
       # List all directories (package categories) in the VDB.
       for category in os.listdir(self._vdb_path):
+         if not self._category_matches(category):
+            continue
          category_path = os.path.join(self._vdb_path, category)
-         # Ignore the sys-kernel category: kernels may contain modules, but
-         # they would then be in-tree modules, not out-of-tree.
-         if category == 'sys-kernel' or not os.path.isdir(category_path):
+         if not os.path.isdir(category_path):
             continue
          # List all directories (package names) in the category.
          for package in os.listdir(category_path):
+            if not self._package_matches(category, package):
+               continue
             package_path = os.path.join(category_path, package)
             if not os.path.isdir(package_path):
                continue
-            files = self._get_package_kernel_modules(package_path)
-            if files:
-               package = category + '/' + package
-               if use_slot:
-                  # Replace the package version with its slot.
-                  slot = self._get_package_slot(package_path)
-                  package = self._package_version_re.sub(':' + slot, package)
-               yield package, files
+            entries = self._get_package_files(package_path)
+            if entries:
+               yield (
+                  category + '/' + package,
+                  self._get_package_slot(package_path), entries
+               )
@@ -0,0 +1,199 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class OutputLog."""
+
+import collections
+import contextlib
+import os
+import subprocess
+import sys
+import threading
+
+##############################################################################
+# OutputLog
+
+class OutputLog(object):
+   """Streams the output of child processes to a rotating log file, keeping
+   only a bounded number of recent lines in memory for error reports.
+
+   Programs can be run concurrently from multiple threads; their output is
+   interleaved line by line in the log file, and each thread keeps its own
+   recent lines.
+   """
+
+   def __init__(
+      self, file_path, max_bytes = 16 * 1024 * 1024, backups = 3,
+      tail_lines = 40
+   ):
+      """Constructor.
+
+      str file_path
+         Path to the log file. Rotated files will have “.1”, “.2”, etc.
+         appended to it.
+      int max_bytes
+         Size after which the log file is rotated.
+      int backups
+         Number of rotated log files to keep.
+      int tail_lines
+         Number of most recent output lines retained in memory.
+      """
+
+      self._backups = backups
+      self._file = None
+      self._file_path = file_path
+      self._lock = threading.Lock()
+      self._max_bytes = max_bytes
+      self._tail_lines = tail_lines
+      # Holds the recent lines of the last program run by each thread.
+      self._thread_state = threading.local()
+
+   def __del__(self):
+      """Destructor."""
+
+      self.close()
+
+   @contextlib.contextmanager
+   def capture(self):
+      """Context manager that redirects the stdout and stderr file
+      descriptors of this process, and therefore of its children, to the
+      log file; used to log the output of code running in this process,
+      such as Portage’s.
+      """
+
+      sys.stdout.flush()
+      sys.stderr.flush()
+      # Ensure the log file is open and has room.
+      self._write(b'')
+      self._file.flush()
+      saved_fds = (os.dup(1), os.dup(2))
+      try:
+         os.dup2(self._file.fileno(), 1)
+         os.dup2(self._file.fileno(), 2)
+         yield
+      finally:
+         sys.stdout.flush()
+         sys.stderr.flush()
+         for fd, saved_fd in enumerate(saved_fds, start=1):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+   def check_call(self, args, env = None, markers = None, on_line = None):
+      """Runs a program, streaming its stdout and stderr to the log file and
+      matching each line against the specified markers.
+
+      iterable(str*) args
+         Program and arguments.
+      dict(str: str) env
+         Environment variable dictionary to use in place of os.environ; if
+         None, os.environ will be used.
+      dict(str: re) markers
+         Regular expressions to match against each output line, by name.
+      callable(str) on_line
+         Function to be called with each output line, as it is read.
+      dict(str: re.Match) return
+         First match for each marker, or None for markers that never matched.
+      """
+
+      matches = dict.fromkeys(markers or ())
+      pending = dict(markers or {})
+      tail = collections.deque(maxlen=self._tail_lines)
+      self._thread_state.tail = tail
+      self._write(b'$ ' + ' '.join(args).encode('utf-8') + b'\n')
+      proc = subprocess.Popen(
+         args, env=env,
+         stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+      )
+      for line in iter(proc.stdout.readline, b''):
+         self._write(line)
+         line = line.decode('utf-8', 'replace').rstrip('\n')
+         tail.append(line)
+         if on_line:
+            on_line(line)
+         for name, marker_re in list(pending.items()):
+            match = marker_re.match(line)
+            if match:
+               matches[name] = match
+               del pending[name]
+      proc.stdout.close()
+      if proc.wait() != 0:
+         raise subprocess.CalledProcessError(proc.returncode, args)
+      return matches
+
+   def close(self):
+      """Closes the log file, if open."""
+
+      with self._lock:
+         if self._file:
+            self._file.close()
+            self._file = None
+
+   def file_path(self):
+      """Returns the path to the current log file.
+
+      str return
+         Path to the log file.
+      """
+
+      return self._file_path
+
+   def tail(self):
+      """Returns the most recent output lines of the last program run by the
+      calling thread.
+
+      list(str) return
+         Output lines, oldest first.
+      """
+
+      return list(getattr(self._thread_state, 'tail', ()))
+
+   def _rotate(self):
+      """Closes the current log file and shifts it and its backups by one,
+      discarding the oldest. The caller must hold self._lock.
+      """
+
+      self._file.close()
+      self._file = None
+      for i in range(self._backups - 1, 0, -1):
+         src_path = '{}.{}'.format(self._file_path, i)
+         if os.path.exists(src_path):
+            os.rename(src_path, '{}.{}'.format(self._file_path, i + 1))
+      if self._backups > 0:
+         os.rename(self._file_path, self._file_path + '.1')
+      else:
+         os.unlink(self._file_path)
+
+   def _write(self, data):
+      """Appends data to the log file, rotating it first if it grew too large.
+
+      bytes data
+         Data to write.
+      """
+
+      with self._lock:
+         if self._file is None:
+            log_dir = os.path.dirname(self._file_path)
+            if log_dir and not os.path.isdir(log_dir):
+               os.makedirs(log_dir)
+            self._file = open(self._file_path, 'ab')
+         elif self._file.tell() >= self._max_bytes:
+            self._rotate()
+            self._file = open(self._file_path, 'ab')
+         self._file.write(data)
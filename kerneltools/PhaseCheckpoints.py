@@ -0,0 +1,151 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class PhaseCheckpoints."""
+
+import json
+import os
+
+##############################################################################
+# PhaseCheckpoints
+
+class PhaseCheckpoints(object):
+   """Persists the phases of a kernel-gen run that have been completed, so
+   that a failed run can be resumed without repeating them.
+   """
+
+   # Phases whose results are invalidated when a phase is (re)done.
+   _dependents = {
+      'ebuild'     : ('modules', ),
+      'initramfs'  : (),
+      'kernel'     : ('modules', 'oot_modules'),
+      'modules'    : ('initramfs', ),
+      'oot_modules': (),
+   }
+
+   def __init__(self, file_path, key):
+      """Constructor.
+
+      str file_path
+         Path to the checkpoint file.
+      dict(str: object) key
+         Inputs of the run; checkpoints saved with a different key are
+         ignored.
+      """
+
+      self._file_path = file_path
+      self._key = key
+      self._phases = {}
+
+   def delete(self):
+      """Forgets all completed phases, deleting the checkpoint file."""
+
+      self._phases = {}
+      if os.path.exists(self._file_path):
+         os.unlink(self._file_path)
+
+   def done(self, phase):
+      """Checks whether a phase was completed.
+
+      str phase
+         Phase name.
+      bool return
+         True if the phase was completed, or False otherwise.
+      """
+
+      return phase in self._phases
+
+   def get(self, phase):
+      """Returns the data recorded when a phase was completed.
+
+      str phase
+         Phase name.
+      dict(str: object) return
+         Data recorded for the phase, or None if the phase was not completed.
+      """
+
+      return self._phases.get(phase)
+
+   def invalidate(self, phase):
+      """Marks a phase and all phases depending on it as not completed.
+
+      str phase
+         Phase name.
+      """
+
+      if self._phases.pop(phase, None) is not None:
+         self._save()
+      for dependent in self._dependents[phase]:
+         self.invalidate(dependent)
+
+   def load(self):
+      """Loads the checkpoints saved by a previous run with the same key.
+
+      bool return
+         True if any completed phases were loaded, or False otherwise.
+      """
+
+      try:
+         with open(self._file_path, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+      except (IOError, OSError, ValueError):
+         return False
+      if checkpoint.get('key') != self._key:
+         return False
+      self._phases = checkpoint.get('phases', {})
+      return bool(self._phases)
+
+   def mark(self, phase, **data):
+      """Records a phase as completed, invalidating any phases depending on it.
+
+      str phase
+         Phase name.
+      dict(str: object) data
+         Data needed to resume after this phase, as JSON-serializable values.
+      """
+
+      for dependent in self._dependents[phase]:
+         self.invalidate(dependent)
+      self._phases[phase] = data
+      self._save()
+
+   def pending(self):
+      """Checks whether a run is incomplete, i.e. some phases have been
+      completed but the checkpoint file has not been deleted yet.
+
+      bool return
+         True if the checkpoint file exists, or False otherwise.
+      """
+
+      return os.path.exists(self._file_path)
+
+   def _save(self):
+      """Writes the checkpoint file, atomically replacing any previous one."""
+
+      checkpoint_dir = os.path.dirname(self._file_path)
+      if not os.path.isdir(checkpoint_dir):
+         os.makedirs(checkpoint_dir)
+      tmp_file_path = self._file_path + '.tmp'
+      with open(tmp_file_path, 'w') as checkpoint_file:
+         json.dump(
+            {'key': self._key, 'phases': self._phases}, checkpoint_file,
+            indent=1, sort_keys=True
+         )
+      os.rename(tmp_file_path, self._file_path)
@@ -0,0 +1,944 @@
+# -*- coding: utf-8; mode: python; tab-width: 3; indent-tabs-mode: nil -*-
+#
+# Copyright 2012-2018 Raffaello D. Di Napoli
+#
+# This file is part of kernel-tools.
+#
+# kernel-tools is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# kernel-tools is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# kernel-tools. If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+"""Implementation of the class PipelineBenchmark.
+
+When executed as a script, this module acts as the stand-in make, emerge,
+ebuild and depmod installed by PipelineBenchmark in its sandbox; for this
+reason, it must only depend on the standard library.
+"""
+
+import collections
+import contextlib
+import gc
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+import types
+
+try:
+   from shlex import quote as shell_quote
+except ImportError:
+   # Python 2.7.
+   from pipes import quote as shell_quote
+
+
+def _generator_class(sandbox_path, emerge_api):
+   """Returns a Generator subclass suitable for the sandbox. It’s only
+   defined when needed, since the Generator module depends on Portage.
+
+   str sandbox_path
+      Path to the sandbox.
+   bool emerge_api
+      If True, the Generator will resolve and merge packages in-process,
+      through stand-ins for Portage’s API; if False, it will always invoke
+      the stand-in emerge, like when Portage’s API is not available.
+   type return
+      Generator subclass.
+   """
+
+   from .Generator import Generator
+
+   class BenchmarkGenerator(Generator):
+      """Generator that never uses Portage’s actual API, which would merge
+      real packages.
+      """
+
+      def resolve_and_merge(self, args, plan):
+         """See Generator.resolve_and_merge()."""
+
+         if not emerge_api:
+            return False
+         with _stand_in_emerge_api(sandbox_path):
+            return Generator.resolve_and_merge(self, args, plan)
+
+   return BenchmarkGenerator
+
+def _kernel_release(source_path, output_path):
+   """Computes the kernel version and release of a stand-in kernel source
+   directory, the same way the kernel’s Makefile would.
+
+   str source_path
+      Path to the kernel source directory.
+   str output_path
+      Path to the build directory, containing .config.
+   tuple(str, str) return
+      Kernel version and release.
+   """
+
+   values = {}
+   with open(os.path.join(source_path, 'Makefile'), 'r') as makefile:
+      for line in makefile:
+         name, sep, value = line.partition('=')
+         if sep:
+            values[name.strip()] = value.strip()
+   version = '{}.{}.{}{}'.format(
+      values['VERSION'], values['PATCHLEVEL'], values['SUBLEVEL'],
+      values.get('EXTRAVERSION', '')
+   )
+   local_version = ''
+   with open(os.path.join(output_path, '.config'), 'r') as config_file:
+      for line in config_file:
+         match = re.match(r'^CONFIG_LOCALVERSION="(?P<value>.*)"$', line)
+         if match:
+            local_version = match.group('value')
+   return version, version + local_version
+
+def _main(argv):
+   """Stand-in tool: records its invocation, then emulates the tool it’s
+   standing in for.
+
+   list(str) argv
+      Script path, sandbox path, tool name, then the tool’s arguments.
+   int return
+      Exit status.
+   """
+
+   sandbox_path = argv[1]
+   tool = argv[2]
+   args = argv[3:]
+   with open(os.path.join(sandbox_path, 'bench.json'), 'r') as params_file:
+      params = json.load(params_file)
+   _record_invocation(sandbox_path, tool, args)
+   return _stand_ins[tool](params, args)
+
+def _module_elf(name, vermagic, size):
+   """Generates a minimal ELF64 relocatable file that looks enough like a
+   kernel module for ModuleInfo to read its vermagic.
+
+   str name
+      Name of the module.
+   str vermagic
+      Vermagic to store in the .modinfo section.
+   int size
+      Size of the .text section.
+   bytes return
+      Contents of the module.
+   """
+
+   text = ((name + '\0').encode('utf-8') * (size // (len(name) + 1) + 1))[
+      :size
+   ]
+   modinfo = 'name={}\0vermagic={}\0'.format(name, vermagic).encode('utf-8')
+   shstrtab = b'\0.text\0.modinfo\0.shstrtab\0'
+   # Lay out the header, the sections, then the section headers.
+   text_offset = 64
+   modinfo_offset = text_offset + len(text)
+   shstrtab_offset = modinfo_offset + len(modinfo)
+   shoff = shstrtab_offset + len(shstrtab)
+   section_fmt = '<IIQQQQIIQQ'
+   return b''.join((
+      # ET_REL, EM_X86_64, 4 sections, section names in the last one.
+      struct.pack(
+         '<16sHHIQQQIHHHHHH', b'\x7fELF\x02\x01\x01', 1, 62, 1, 0, 0, shoff,
+         0, 64, 0, 0, 64, 4, 3
+      ),
+      text, modinfo, shstrtab,
+      struct.pack(section_fmt, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+      struct.pack(
+         section_fmt, 1, 1, 6, 0, text_offset, len(text), 0, 0, 16, 0
+      ),
+      struct.pack(
+         section_fmt, 7, 1, 2, 0, modinfo_offset, len(modinfo), 0, 0, 1, 0
+      ),
+      struct.pack(
+         section_fmt, 16, 3, 0, 0, shstrtab_offset, len(shstrtab), 0, 0, 1, 0
+      ),
+   ))
+
+def _record_invocation(sandbox_path, tool, args):
+   """Records the invocation of a stand-in in the sandbox.
+
+   str sandbox_path
+      Path to the sandbox.
+   str tool
+      Name of the stand-in.
+   list(str) args
+      Arguments of the invocation.
+   """
+
+   record = json.dumps({'tool': tool, 'args': args}) + '\n'
+   # Write each record with a single append, so that records written by
+   # concurrent stand-ins don’t get mixed up.
+   log_fd = os.open(
+      os.path.join(sandbox_path, 'invocations.log'),
+      os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+   )
+   try:
+      os.write(log_fd, record.encode('utf-8'))
+   finally:
+      os.close(log_fd)
+
+def _stand_in_depmod(params, args):
+   """Stand-in depmod: writes a modules.dep listing every module, without
+   resolving any dependencies.
+
+   dict(str: object) params
+      Sandbox parameters.
+   list(str) args
+      Command-line arguments.
+   int return
+      Exit status.
+   """
+
+   base_path = args[args.index('--basedir') + 1]
+   modules_path = os.path.join(base_path, 'lib/modules', args[-1])
+   modules_path_len = len(modules_path) + 1
+   with open(os.path.join(modules_path, 'modules.dep'), 'w') as dep_file:
+      for dir_path, dir_names, file_names in os.walk(modules_path):
+         for file_name in sorted(file_names):
+            if '.ko' in file_name:
+               dep_file.write(
+                  os.path.join(dir_path, file_name)[modules_path_len:] + ':\n'
+               )
+   return 0
+
+def _stand_in_ebuild(params, args):
+   """Stand-in ebuild: manages the build directory of the ebuild, and turns
+   its ${D} into an uncompressed binary package.
+
+   dict(str: object) params
+      Sandbox parameters.
+   list(str) args
+      Command-line arguments.
+   int return
+      Exit status.
+   """
+
+   ebuild_path = args[0]
+   package_path = os.path.dirname(ebuild_path)
+   category = os.path.basename(os.path.dirname(package_path))
+   pf = os.path.basename(ebuild_path)[:-len('.ebuild')]
+   build_path = os.path.join(
+      params['portage_tmp_path'], 'portage', category, pf
+   )
+   d_path = os.path.join(build_path, 'image') + '/'
+   for command in args[1:]:
+      if command == 'clean':
+         shutil.rmtree(build_path, ignore_errors=True)
+      elif command == 'manifest':
+         with open(os.path.join(package_path, 'Manifest'), 'w'):
+            pass
+      elif command == 'install':
+         os.makedirs(d_path)
+         print('KERNEL-GEN: D=' + d_path)
+      elif command == 'package':
+         binpkg_path = os.path.join(params['pkgdir_path'], category)
+         if not os.path.isdir(binpkg_path):
+            os.makedirs(binpkg_path)
+         with tarfile.open(
+            os.path.join(binpkg_path, pf + '.tbz2'), 'w'
+         ) as binpkg:
+            binpkg.add(d_path, '.')
+      else:
+         sys.stderr.write('ebuild: unsupported command: {}\n'.format(command))
+         return 1
+   return 0
+
+def _stand_in_emerge(params, args):
+   """Stand-in emerge: does nothing.
+
+   dict(str: object) params
+      Sandbox parameters.
+   list(str) args
+      Command-line arguments.
+   int return
+      Exit status.
+   """
+
+   return 0
+
+@contextlib.contextmanager
+def _stand_in_emerge_api(sandbox_path):
+   """Context manager that makes the parts of Portage’s private emerge API
+   used by Generator.resolve_and_merge() importable as in-process stand-ins.
+   Each atom resolves to a single task, without dependencies, and each merge
+   is recorded as an invocation of “emerge-api” with its atoms.
+
+   str sandbox_path
+      Path to the sandbox.
+   """
+
+   class Namespace(object):
+      """Object with the attributes passed to its constructor."""
+
+      def __init__(self, **attrs):
+         self.__dict__.update(attrs)
+
+   class Config(object):
+      """Stand-in Portage configuration."""
+
+      def __init__(self, env):
+         """Constructor.
+
+         dict(str: str) env
+            Environment variables.
+         """
+
+         self.configdict = {'backupenv': dict(env), 'env': dict(env)}
+
+      def backup_changes(self, name):
+         self.configdict['backupenv'][name] = self.configdict['env'][name]
+
+      def __getitem__(self, name):
+         return self.configdict['env'][name]
+
+      def lock(self):
+         pass
+
+      def __setitem__(self, name, value):
+         self.configdict['env'][name] = value
+
+      def unlock(self):
+         pass
+
+   class Depgraph(object):
+      """Stand-in dependency graph."""
+
+      def __init__(self, tasks):
+         """Constructor.
+
+         list(Task) tasks
+            Tasks to merge.
+         """
+
+         self._tasks = tasks
+
+      def altlist(self):
+         return list(self._tasks)
+
+      def display_problems(self):
+         pass
+
+   class Scheduler(object):
+      """Stand-in merge scheduler."""
+
+      def __init__(
+         self, settings, trees, mtimedb, opts, spinner, tasks, favorites,
+         graph_config
+      ):
+         """Constructor; see _emerge.Scheduler.Scheduler."""
+
+         self._opts = opts
+         self._tasks = tasks
+
+      def merge(self):
+         _record_invocation(sandbox_path, 'emerge-api', sorted(
+            opt for opt, value in self._opts.items() if value
+         ) + [task.atom for task in self._tasks])
+         return os.EX_OK
+
+   class Task(object):
+      """Stand-in merge task, also used as a stand-in favorite atom."""
+
+      def __init__(self, atom):
+         """Constructor.
+
+         str atom
+            Atom of the package.
+         """
+
+         self.atom = atom
+         self.cp = re.sub(
+            r'-[0-9].*$', '', re.sub(r'^[<>=~!]+', '', atom.split(':')[0])
+         )
+         self.operation = 'merge'
+
+   def backtrack_depgraph(
+      settings, trees, opts, params, action, atoms, spinner
+   ):
+      tasks = [Task(atom) for atom in atoms]
+      return True, Depgraph(tasks), tasks
+
+   def load_emerge_config(
+      emerge_config = None, env = None, action = None, args = None,
+      opts = None
+   ):
+      settings = Config(os.environ if env is None else env)
+      settings['EROOT'] = os.environ.get('ROOT', '/')
+      return Namespace(
+         target_config=Namespace(settings=settings, mtimedb={}),
+         trees={settings['EROOT']: {
+            'vartree': Namespace(settings=settings)
+         }}
+      )
+
+   def parse_opts(args, silent = False):
+      opts = {}
+      atoms = []
+      args = iter(args)
+      for arg in args:
+         if not arg.startswith('--'):
+            atoms.append(arg)
+         elif '=' in arg:
+            name, value = arg.split('=', 1)
+            opts[name] = value
+         elif arg in ('--reinstall-atoms', '--usepkg-exclude'):
+            opts[arg] = next(args)
+         else:
+            opts[arg] = True
+      return None, opts, atoms
+
+   modules = {}
+   for name, attrs in (
+      ('_emerge', {}),
+      ('_emerge.actions', {'load_emerge_config': load_emerge_config}),
+      ('_emerge.create_depgraph_params', {
+         'create_depgraph_params': lambda opts, action: {}
+      }),
+      ('_emerge.depgraph', {'backtrack_depgraph': backtrack_depgraph}),
+      ('_emerge.main', {'parse_opts': parse_opts}),
+      ('_emerge.Scheduler', {'Scheduler': Scheduler}),
+      ('_emerge.stdout_spinner', {
+         'stdout_spinner': lambda: Namespace(
+            update=None, update_quiet=None
+         )
+      }),
+   ):
+      modules[name] = types.ModuleType(name)
+      modules[name].__dict__.update(attrs)
+   saved_modules = dict((name, sys.modules.get(name)) for name in modules)
+   sys.modules.update(modules)
+   try:
+      yield
+   finally:
+      for name, module in saved_modules.items():
+         if module is None:
+            del sys.modules[name]
+         else:
+            sys.modules[name] = module
+
+def _stand_in_make(params, args):
+   """Stand-in kernel make: answers informative targets, “builds” the image
+   and a set of synthetic modules, and installs them.
+
+   dict(str: object) params
+      Sandbox parameters.
+   list(str) args
+      Command-line arguments.
+   int return
+      Exit status.
+   """
+
+   source_path = os.getcwd()
+   variables = {}
+   targets = []
+   args = iter(args)
+   for arg in args:
+      if arg in ('--directory', '-C'):
+         source_path = next(args)
+      elif arg.startswith('-'):
+         # Job options, --quiet, etc.
+         pass
+      elif '=' in arg:
+         name, value = arg.split('=', 1)
+         variables[name] = value
+      else:
+         targets.append(arg)
+   output_path = variables.get('O', source_path)
+   image_path = os.path.join(output_path, 'arch/x86/boot/bzImage')
+
+   if 'kernelversion' in targets:
+      print(_kernel_release(source_path, source_path)[0])
+      return 0
+   version, release = _kernel_release(source_path, output_path)
+   if 'kernelrelease' in targets:
+      print(release)
+   elif 'image_name' in targets:
+      print(os.path.relpath(image_path, output_path))
+   elif 'modules_prepare' in targets:
+      pass
+   elif 'modules_install' in targets:
+      install_path = os.path.join(
+         variables['INSTALL_MOD_PATH'], 'lib/modules', release
+      )
+      with open(os.path.join(output_path, 'modules.order'), 'r') as order_file:
+         module_paths = order_file.read().splitlines()
+      for module_path in module_paths:
+         dst_module_path = os.path.join(install_path, 'kernel', module_path)
+         if not os.path.isdir(os.path.dirname(dst_module_path)):
+            os.makedirs(os.path.dirname(dst_module_path))
+         shutil.copyfile(
+            os.path.join(output_path, module_path), dst_module_path
+         )
+      with open(
+         os.path.join(install_path, 'modules.order'), 'w'
+      ) as order_file:
+         for module_path in module_paths:
+            order_file.write('kernel/' + module_path + '\n')
+      with open(os.path.join(install_path, 'modules.builtin'), 'w'):
+         pass
+      for link_name, link_target in (
+         ('build', output_path), ('source', source_path)
+      ):
+         os.symlink(link_target, os.path.join(install_path, link_name))
+   elif not targets:
+      if not os.path.isdir(os.path.dirname(image_path)):
+         os.makedirs(os.path.dirname(image_path))
+      with open(image_path, 'wb') as image_file:
+         image_file.write(b'\0' * params['image_size'])
+      vermagic = release + ' SMP mod_unload '
+      module_paths = []
+      for i in range(params['modules']):
+         # Put some modules in directories kernel-gen excludes from the
+         # initramfs.
+         module_path = '{}/bench/bench{}.ko'.format(
+            'sound' if i % 5 == 4 else 'drivers', i
+         )
+         module_paths.append(module_path)
+         module_path = os.path.join(output_path, module_path)
+         if not os.path.isdir(os.path.dirname(module_path)):
+            os.makedirs(os.path.dirname(module_path))
+         with open(module_path, 'wb') as module_file:
+            module_file.write(_module_elf(
+               'bench{}'.format(i), vermagic, params['module_size']
+            ))
+      with open(os.path.join(output_path, 'modules.order'), 'w') as order_file:
+         order_file.write(''.join(path + '\n' for path in module_paths))
+      for file_name in ('System.map', 'Module.symvers'):
+         with open(os.path.join(output_path, file_name), 'w'):
+            pass
+   else:
+      sys.stderr.write('make: unsupported targets: {}\n'.format(
+         ' '.join(targets)
+      ))
+      return 2
+   return 0
+
+# Stand-in tools, by name.
+_stand_ins = {
+   'depmod': _stand_in_depmod,
+   'ebuild': _stand_in_ebuild,
+   'emerge': _stand_in_emerge,
+   'make'  : _stand_in_make,
+}
+
+##############################################################################
+# PipelineBenchmark
+
+class PipelineBenchmark(object):
+   """Runs the whole Generator pipeline (set_sources(), create_ebuild(),
+   build_kernel(), package() and install()) in a sandbox with a fake Portage
+   configuration, ${ROOT} and kernel source, where make, emerge, ebuild,
+   depmod and Portage’s emerge API are fast stand-ins, and measures the time
+   and resources used by each phase, to expose the overhead of kernel-gen
+   itself.
+
+   Setting up the sandbox changes the environment of the current process, so
+   that the stand-ins and the fake Portage configuration are used; Portage’s
+   global configuration must not have been loaded before that.
+   """
+
+   # Kernel version of the fake kernel source.
+   _kernel_version = '6.1.0'
+   # Local version of the fake kernel configuration.
+   _local_version = '-bench'
+
+   def __init__(
+      self, work_path = None, modules = 500, module_size = 16 * 1024,
+      firmware = 100, firmware_size = 64 * 1024, packages = 1000,
+      variants = 0, emerge_api = True
+   ):
+      """Constructor.
+
+      str work_path
+         Directory in which the sandbox will be created; defaults to a new
+         temporary directory, deleted by cleanup().
+      int modules
+         Number of synthetic in-tree modules built by the stand-in make.
+      int module_size
+         Size of each synthetic module, in bytes.
+      int firmware
+         Number of synthetic firmware files installed in ${ROOT}; one in
+         four is a duplicate of another under a different name.
+      int firmware_size
+         Size of each synthetic firmware file, in bytes.
+      int packages
+         Number of additional packages, without modules or firmware, in the
+         VDB of ${ROOT}.
+      int variants
+         Number of named initramfs variants to build, in addition to the
+         default initramfs.
+      bool emerge_api
+         If True (default), packages will be resolved and merged in-process,
+         through stand-ins for Portage’s API; if False, the stand-in emerge
+         will be invoked instead, as when Portage’s API is not available.
+      """
+
+      self._delete_work_path = work_path is None
+      self._emerge_api = emerge_api
+      self._firmware = firmware
+      self._firmware_size = firmware_size
+      self._module_size = module_size
+      self._modules = modules
+      self._packages = packages
+      self._variants = variants
+      self._work_path = os.path.abspath(
+         work_path or tempfile.mkdtemp(prefix='kernel-gen-bench.')
+      )
+      self._config_root_path = os.path.join(self._work_path, 'config')
+      self._irf_source_path = os.path.join(self._work_path, 'initramfs')
+      self._overlay_path = os.path.join(self._work_path, 'overlay')
+      self._root_path = os.path.join(self._work_path, 'root')
+      self._source_path = os.path.join(self._work_path, 'src/linux')
+      self._invocations_path = os.path.join(
+         self._work_path, 'invocations.log'
+      )
+
+   def cleanup(self):
+      """Deletes the sandbox, if it was created in a temporary directory."""
+
+      if self._delete_work_path:
+         shutil.rmtree(self._work_path, ignore_errors=True)
+
+   def _create_portage_config(self):
+      """Creates the fake Portage configuration, with a minimal profile and a
+      single overlay that will receive the temporary ebuild.
+      """
+
+      portage_path = os.path.join(self._config_root_path, 'etc/portage')
+      self._write_file(os.path.join(portage_path, 'make.conf'), ''.join(
+         '{}="{}"\n'.format(name, value) for name, value in (
+            ('MAKEOPTS', '-j1'),
+            ('PKGDIR', os.path.join(self._work_path, 'packages')),
+            ('PORTAGE_TMPDIR', os.path.join(self._work_path, 'tmp')),
+         )
+      ))
+      self._write_file(
+         os.path.join(portage_path, 'make.profile/make.defaults'),
+         'ARCH="amd64"\nACCEPT_KEYWORDS="amd64"\n'
+      )
+      self._write_file(
+         os.path.join(portage_path, 'make.profile/eapi'), '5\n'
+      )
+      self._write_file(
+         os.path.join(portage_path, 'repos.conf/bench.conf'),
+         '[DEFAULT]\nmain-repo = bench\n\n[bench]\nlocation = {}\n'.format(
+            self._overlay_path
+         )
+      )
+      self._write_file(
+         os.path.join(self._overlay_path, 'profiles/repo_name'), 'bench\n'
+      )
+      self._write_file(
+         os.path.join(self._overlay_path, 'metadata/layout.conf'),
+         'masters =\nthin-manifests = true\n'
+      )
+      os.makedirs(os.path.join(self._work_path, 'tmp'))
+
+   def _create_root(self):
+      """Creates the fake ${ROOT}, with a VDB listing packages that installed
+      firmware, an out-of-tree module built for an older kernel, and
+      unrelated files.
+      """
+
+      kernel_release = self._kernel_version + self._local_version
+      firmware_paths = []
+      for i in range(self._firmware):
+         firmware_path = 'lib/firmware/bench/fw{}.bin'.format(i)
+         # Install one in four firmware files twice, under different names.
+         content_index = i - 1 if i % 4 == 3 else i
+         block = hashlib.sha256(str(content_index).encode('ascii')).digest()
+         self._write_file(
+            os.path.join(self._root_path, firmware_path),
+            block * (self._firmware_size // len(block)), 'wb'
+         )
+         firmware_paths.append(firmware_path)
+      self._write_vdb_package(
+         'sys-firmware/bench-firmware-1', firmware_paths
+      )
+
+      module_path = 'lib/modules/{}/extra/bench-oot.ko'.format(kernel_release)
+      self._write_file(
+         os.path.join(self._root_path, module_path),
+         _module_elf('bench-oot', '0.0.0 SMP mod_unload ', 4096), 'wb'
+      )
+      self._write_vdb_package('net-misc/bench-modules-1', [module_path])
+
+      for i in range(self._packages):
+         self._write_vdb_package('app-misc/bench-filler{}-1'.format(i), [
+            'usr/share/bench-filler{}/file{}'.format(i, j) for j in range(20)
+         ])
+
+   def _create_sources(self):
+      """Creates the fake kernel source directory, configured for an
+      initramfs, and the initramfs source directory.
+      """
+
+      self._write_file(os.path.join(self._source_path, 'Makefile'), ''.join(
+         '{} = {}\n'.format(name, value) for name, value in zip(
+            ('VERSION', 'PATCHLEVEL', 'SUBLEVEL'),
+            self._kernel_version.split('.')
+         )
+      ))
+      self._write_file(os.path.join(self._source_path, '.config'), ''.join(
+         line + '\n' for line in (
+            '#',
+            '# Automatically generated file; DO NOT EDIT.',
+            '# Linux/x86 {} Kernel Configuration'.format(
+               self._kernel_version
+            ),
+            '#',
+            'CONFIG_LOCALVERSION="{}"'.format(self._local_version),
+            'CONFIG_MODULES=y',
+            'CONFIG_BLK_DEV_INITRD=y',
+            'CONFIG_RD_GZIP=y',
+            'CONFIG_KERNEL_GZIP=y',
+         )
+      ))
+      self._write_file(
+         os.path.join(self._irf_source_path, 'init'), '#!/bin/sh\n'
+      )
+      os.chmod(os.path.join(self._irf_source_path, 'init'), 0o755)
+      for i in range(50):
+         self._write_file(
+            os.path.join(self._irf_source_path, 'bin/tool{}'.format(i)),
+            b'\x7fELF' + os.urandom(16 * 1024), 'wb'
+         )
+
+   def _create_stand_ins(self):
+      """Installs the stand-in tools in a directory, and prepends it to
+      ${PATH}.
+      """
+
+      bin_path = os.path.join(self._work_path, 'bin')
+      for tool in _stand_ins:
+         tool_path = os.path.join(bin_path, tool)
+         self._write_file(tool_path, '#!/bin/sh\nexec {} "$@"\n'.format(
+            ' '.join(shell_quote(arg) for arg in (
+               sys.executable, os.path.abspath(__file__), self._work_path,
+               tool
+            ))
+         ))
+         os.chmod(tool_path, 0o755)
+      os.environ['PATH'] = bin_path + os.pathsep + os.environ.get('PATH', '')
+
+   def _invocations(self):
+      """Counts the invocations of each stand-in tool so far.
+
+      collections.Counter(str: int) return
+         Number of invocations, by tool.
+      """
+
+      ret = collections.Counter()
+      if os.path.exists(self._invocations_path):
+         with open(self._invocations_path, 'r') as invocations_file:
+            for line in invocations_file:
+               ret[json.loads(line)['tool']] += 1
+      return ret
+
+   def run(self, iterations = 3):
+      """Runs the pipeline multiple times, reporting the best result of each
+      phase, which is the least affected by other activity on the system.
+
+      int iterations
+         Number of runs.
+      collections.OrderedDict(str: dict(str: object)) return
+         Statistics of each phase, in the order the phases started, plus a
+         “total” entry; see _run_once().
+      """
+
+      runs = [self._run_once() for i in range(iterations)]
+      ret = collections.OrderedDict()
+      for phase, stats in runs[0].items():
+         ret[phase] = dict(stats)
+         for key in (
+            'children_cpu_time', 'cpu_time', 'process_time', 'wall_time'
+         ):
+            ret[phase][key] = min(run[phase][key] for run in runs)
+      return ret
+
+   def _run_once(self):
+      """Runs the pipeline once, on a kernel that needs to be rebuilt.
+
+      collections.OrderedDict(str: dict(str: object)) return
+         Statistics of each phase, in the order the phases started, plus a
+         “total” entry for the whole run, including the creation and
+         destruction of the Generator. Each contains the wall time, the CPU
+         time used by kernel-gen and by its children, the number of logged
+         child processes and the time they took, the number of invocations
+         of each stand-in tool, the files and bytes copied and replaced with
+         hardlinks, the number of VDB scans, and the depth of the phase (1
+         for phases run by other phases).
+      """
+
+      from .OutOfTreeEnumerator import OutOfTreeEnumerator
+
+      # Make build_kernel() “build” the kernel again.
+      image_path = os.path.join(self._source_path, 'arch/x86/boot/bzImage')
+      if os.path.exists(image_path):
+         os.unlink(image_path)
+
+      phases = collections.OrderedDict()
+      stack = []
+
+      def new_stats(depth):
+         return {
+            'children_cpu_time': 0.0, 'copied_bytes': 0, 'copied_files': 0,
+            'cpu_time': 0.0, 'deduplicated_bytes': 0,
+            'deduplicated_files': 0, 'depth': depth, 'process_time': 0.0,
+            'processes': 0, 'tools': {}, 'vdb_scans': 0, 'wall_time': 0.0,
+         }
+
+      def on_event(event):
+         event_type = event['event']
+         if event_type == 'phase_start':
+            stats = new_stats(len(stack))
+            stats['invocations'] = self._invocations()
+            phases[event['phase']] = stats
+            stack.append(stats)
+         elif event_type == 'phase_end':
+            stats = stack.pop()
+            stats['tools'] = dict(
+               self._invocations() - stats.pop('invocations')
+            )
+            for key, event_key in (
+               ('children_cpu_time', 'children_cpu_time'),
+               ('cpu_time', 'cpu_time'),
+               ('wall_time', 'duration'),
+            ):
+               stats[key] = event[event_key]
+         elif event_type == 'process_exit':
+            # Nested phases’ processes also count for the outer phases.
+            for stats in stack:
+               stats['processes'] += 1
+               stats['process_time'] += event['duration']
+         elif event_type in ('copy', 'deduplicate'):
+            prefix = 'copied_' if event_type == 'copy' else 'deduplicated_'
+            for stats in stack:
+               stats[prefix + 'files'] += event['files']
+               stats[prefix + 'bytes'] += event['bytes']
+
+      scan_vdb = OutOfTreeEnumerator._scan_vdb
+
+      def counting_scan_vdb(oote):
+         for stats in stack:
+            stats['vdb_scans'] += 1
+         return scan_vdb(oote)
+
+      irf_variants = collections.OrderedDict(
+         ('variant{}'.format(i), self._irf_source_path)
+         for i in range(self._variants)
+      )
+      total = new_stats(0)
+      start_invocations = self._invocations()
+      start_usage = os.times()
+      start = time.time()
+      # Count every scan, however the enumerator is used.
+      OutOfTreeEnumerator._scan_vdb = counting_scan_vdb
+      try:
+         gen = _generator_class(self._work_path, self._emerge_api)(
+            root=self._root_path, portage_arch='amd64', console=False
+         )
+         gen.events().subscribe(on_event)
+         gen.set_sources(
+            self._source_path, self._irf_source_path, irf_variants
+         )
+         gen.create_ebuild('bench')
+         gen.build_kernel()
+         gen.package()
+         gen.install()
+         # Let the Generator clean up after itself.
+         del gen
+         gc.collect()
+      finally:
+         OutOfTreeEnumerator._scan_vdb = scan_vdb
+      total['wall_time'] = time.time() - start
+      usage = os.times()
+      total['cpu_time'] = usage[0] + usage[1] - start_usage[0] - \
+         start_usage[1]
+      total['children_cpu_time'] = usage[2] + usage[3] - start_usage[2] - \
+         start_usage[3]
+      total['tools'] = dict(self._invocations() - start_invocations)
+      for stats in phases.values():
+         if stats['depth'] == 0:
+            for key in (
+               'copied_bytes', 'copied_files', 'deduplicated_bytes',
+               'deduplicated_files', 'process_time', 'processes', 'vdb_scans'
+            ):
+               total[key] += stats[key]
+      phases['total'] = total
+      return phases
+
+   def setup(self):
+      """Creates the sandbox and points Portage and ${PATH} to it."""
+
+      self._create_portage_config()
+      self._create_root()
+      self._create_sources()
+      self._create_stand_ins()
+      params = {
+         'image_size': 8 * 1024 * 1024,
+         'module_size': self._module_size,
+         'modules': self._modules,
+         'pkgdir_path': os.path.join(self._work_path, 'packages'),
+         'portage_tmp_path': os.path.join(self._work_path, 'tmp'),
+      }
+      self._write_file(
+         os.path.join(self._work_path, 'bench.json'), json.dumps(params)
+      )
+      os.environ['PORTAGE_CONFIGROOT'] = self._config_root_path
+      os.environ['ROOT'] = self._root_path
+
+   @staticmethod
+   def _write_file(file_path, content, mode = 'w'):
+      """Writes a file, creating its directory if needed.
+
+      str file_path
+         Path to the file.
+      str|bytes content
+         Content of the file.
+      str mode
+         “w” for text content, “wb” for binary content.
+      """
+
+      dir_path = os.path.dirname(file_path)
+      if not os.path.isdir(dir_path):
+         os.makedirs(dir_path)
+      with open(file_path, mode) as out_file:
+         out_file.write(content)
+
+   def _write_vdb_package(self, cpv, file_paths):
+      """Adds an installed package to the VDB of ${ROOT}.
+
+      str cpv
+         Category, name and version of the package.
+      iterable(str*) file_paths
+         Paths of the files installed by the package, relative to ${ROOT}.
+      """
+
+      package_path = os.path.join(self._root_path, 'var/db/pkg', cpv)
+      self._write_file(os.path.join(package_path, 'SLOT'), '0\n')
+      self._write_file(os.path.join(package_path, 'CONTENTS'), ''.join(
+         'obj /{} {} {}\n'.format(
+            file_path, hashlib.md5(file_path.encode('utf-8')).hexdigest(),
+            int(time.time())
+         ) for file_path in file_paths
+      ))
+
+if __name__ == '__main__':
+   sys.exit(_main(sys.argv))